@@ -2,7 +2,7 @@ from collections import namedtuple
 import logging
 import pandas
 
-from utils.gwas import get_topk_snps
+from utils.gwas import get_topk_snps, read_gwas
 from utils.plink import run_plink
 
 
@@ -13,7 +13,7 @@ def write_snplist(gwas_path: str, max_snp_count: int):
         gwas_path (str): Path to plink 2.0 GWAS results with LOG10_P values
         max_snp_count (int): 
     """    
-    gwas = pandas.read_table(gwas_path).set_index('ID')
+    gwas = read_gwas(gwas_path)
     
     topk_snps = get_topk_snps(gwas, max_snp_count)
     
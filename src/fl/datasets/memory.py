@@ -1,10 +1,24 @@
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
+import json
+import os
+import uuid
+from typing import List, Optional, Tuple
 import numpy
 import pandas
 from pgenlib import PgenReader
+try:
+    import pyarrow.csv as pyarrow_csv
+except ImportError:
+    pyarrow_csv = None
 
 
-def load_from_pgen(pfile_path: str, gwas_path: str, snp_count: int, sample_indices=None, missing='zero') -> numpy.ndarray:
+# number of variants decoded by PgenReader per call when streaming genotypes
+SNP_CHUNK_SIZE = 4096
+
+
+def load_from_pgen(pfile_path: str, gwas_path: str, snp_count: int, sample_indices=None, missing='zero',
+                   out_path: Optional[str] = None, chunk_size: int = SNP_CHUNK_SIZE) -> numpy.ndarray:
     """
     Loads genotypes from .pgen into numpy array and selects top {snp_count} snps
 
@@ -13,7 +27,13 @@ def load_from_pgen(pfile_path: str, gwas_path: str, snp_count: int, sample_indic
         gwas_path (str): Path to plink 2.0 GWAS results file generated by plink 2.0 --glm. 
         snp_count (int): Number of most significant SNPs to load. If None then load all SNPs
         sample_indices (numpy.ndarray): Indices of which samples to load genotypes for. Default of None loads all indices.
-        missing (str): Strategy of filling missing values. Default is 'zero', i.e. homozygous reference value. Other is 'mean'.
+        missing (str): Strategy of filling missing values. Default is 'zero', i.e. homozygous reference value. 
+            Other is 'mean', i.e. the rounded mean genotype of SNP.
+        out_path (Optional[str]): Path to .npy file. If set, genotypes are written into a memory-mapped temporary file
+            which is renamed to {out_path} only after all SNPs are written and returned read-only. 
+            If {out_path} already exists with the requested shape, it is reopened read-only and .pgen is not read.
+            Callers are responsible for making {out_path} unique to the input files. Default of None keeps genotypes in RAM.
+        chunk_size (int): Number of SNPs to read from .pgen at once.
 
     Raises:
         ValueError: If snp_count is greated than number of SNPs in .pgen
@@ -21,31 +41,151 @@ def load_from_pgen(pfile_path: str, gwas_path: str, snp_count: int, sample_indic
     Returns:
         numpy.ndarray: An int8 sample-major array with {snp_count} genotypes
     """    
-    reader = PgenReader((pfile_path + '.pgen').encode('utf-8'), sample_subset=sample_indices)
-    max_snp_count = reader.get_variant_ct()
-    
-    if sample_indices is not None:
-        sample_count = len(sample_indices)
-        sample_indices = numpy.arange(sample_count).astype(numpy.uint32)
-    else:
-        sample_count = reader.get_raw_sample_ct()
-    
+    raw_sample_count, max_snp_count = read_pgen_meta(pfile_path)
     if snp_count is not None and snp_count > max_snp_count:
         raise ValueError(f'snp_count {snp_count} should be not greater than max_snp_count {max_snp_count}')
     
+    sample_count = raw_sample_count if sample_indices is None else len(sample_indices)
     snp_count = max_snp_count if snp_count is None else snp_count
-    array = numpy.empty((sample_count, snp_count), dtype=numpy.int8)
+    if out_path is not None and os.path.exists(out_path):
+        existing = numpy.load(out_path, mmap_mode='r')
+        if existing.shape == (sample_count, snp_count):
+            return existing
+
+    if out_path is None:
+        array = numpy.empty((sample_count, snp_count), dtype=numpy.int8)
+        _read_genotypes(pfile_path, gwas_path, sample_indices, missing, chunk_size, max_snp_count, array)
+        return array
+
+    # partially written file must never be visible at {out_path}, other runs would reuse it
+    tmp_path = _temporary_path(out_path)
+    try:
+        array = numpy.lib.format.open_memmap(tmp_path, mode='w+', dtype=numpy.int8, shape=(sample_count, snp_count))
+        _read_genotypes(pfile_path, gwas_path, sample_indices, missing, chunk_size, max_snp_count, array)
+        array.flush()
+        del array
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return numpy.load(out_path, mmap_mode='r')
+
+
+def _temporary_path(path: str) -> str:
+    # unique file in the same directory, so that os.replace onto {path} is an atomic rename
+    return f'{path}.{uuid.uuid4().hex}.tmp'
+
+
+def _read_genotypes(pfile_path: str, gwas_path: str, sample_indices: Optional[numpy.ndarray], missing: str, 
+                    chunk_size: int, max_snp_count: int, array: numpy.ndarray) -> None:
+    sample_count, snp_count = array.shape
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        # GWAS and .pvar parsing runs while .pgen is opened
+        if snp_count != max_snp_count:
+            snp_list_future = pool.submit(get_snp_list, pfile_path, gwas_path, snp_count)
+
+        reader = PgenReader((pfile_path + '.pgen').encode('utf-8'), sample_subset=sample_indices)
+        chunk_future = None
+        try:
+            snp_indices = None if snp_count == max_snp_count else snp_list_future.result()
+
+            # per-SNP statistics need SNP-major chunks to reduce over contiguous memory, they are transposed once on copy
+            sample_maj = missing != 'mean'
+
+            def chunk_shape(length: int) -> Tuple[int, int]:
+                return (sample_count, length) if sample_maj else (length, sample_count)
+
+            # PgenReader needs a contiguous output buffer, column slabs of {array} are not contiguous
+            # two buffers let the next chunk be decoded while the current one is processed
+            buffers = [numpy.empty(chunk_shape(min(chunk_size, snp_count)), dtype=numpy.int8) for _ in range(2)]
+            starts = list(range(0, snp_count, chunk_size))
+
+            def submit_read(chunk_index: int):
+                start = starts[chunk_index]
+                end = min(start + chunk_size, snp_count)
+                buffer = buffers[chunk_index % 2]
+                chunk = buffer if buffer.shape == chunk_shape(end - start) else numpy.empty(chunk_shape(end - start), dtype=numpy.int8)
+                variant_indices = None if snp_indices is None else snp_indices[start:end]
+                return pool.submit(_read_chunk, reader, start, end, variant_indices, chunk, sample_maj)
+
+            chunk_future = submit_read(0) if len(starts) > 0 else None
+            for chunk_index, start in enumerate(starts):
+                chunk = chunk_future.result()
+                if chunk_index + 1 < len(starts):
+                    chunk_future = submit_read(chunk_index + 1)
+                if missing == 'zero':
+                    chunk[chunk < 0] = 0
+                elif missing == 'mean':
+                    impute_mean_(chunk)
+                array[:, start:start + chunk.shape[1 if sample_maj else 0]] = chunk if sample_maj else chunk.T
+        finally:
+            # reader must not be closed while the next chunk is still being read from it
+            if chunk_future is not None:
+                wait([chunk_future])
+            reader.close()
+
+
+def read_pgen_meta(pfile_path: str) -> Tuple[int, int]:
+    """Returns sample and variant counts of .pgen. Counts are cached in {pfile_path}.meta.json together with 
+    size and modification time of .pgen, so that subsequent calls do not parse .pgen header until it is regenerated.
+    If the data directory is not writable, counts are not cached
+
+    Args:
+        pfile_path (str): Path to plink 2.0 .pgen, .pvar, .psam dataset. It should not have a .pgen extension.
+
+    Returns:
+        Tuple[int, int]: Number of samples and number of variants in .pgen
+    """    
+    meta_path = pfile_path + '.meta.json'
+    pgen_stat = os.stat(pfile_path + '.pgen')
+    pgen_version = {'pgen_size': pgen_stat.st_size, 'pgen_mtime_ns': pgen_stat.st_mtime_ns}
+    try:
+        with open(meta_path, 'r') as meta_file:
+            meta = json.load(meta_file)
+        if all(meta.get(key) == value for key, value in pgen_version.items()):
+            return meta['sample_count'], meta['variant_count']
+    except (OSError, ValueError, KeyError):
+        # missing, unreadable or malformed sidecar is rebuilt from .pgen header
+        pass
     
-    if snp_count is None or snp_count == max_snp_count:
-        reader.read_range(0, max_snp_count, array, sample_maj=True)
+    reader = PgenReader((pfile_path + '.pgen').encode('utf-8'))
+    sample_count, variant_count = reader.get_raw_sample_ct(), reader.get_variant_ct()
+    reader.close()
+    meta = {'sample_count': sample_count, 'variant_count': variant_count, **pgen_version}
+    # concurrent readers see either the old or the new sidecar, never a partially written one
+    tmp_path = _temporary_path(meta_path)
+    try:
+        with open(tmp_path, 'w') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(tmp_path, meta_path)
+    except OSError:
+        # e.g. read-only data directory, counts are read from .pgen header every time
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return sample_count, variant_count
+
+
+def _read_chunk(reader: PgenReader, start: int, end: int, variant_indices: Optional[numpy.ndarray], 
+                chunk: numpy.ndarray, sample_maj: bool) -> numpy.ndarray:
+    if variant_indices is None:
+        reader.read_range(start, end, chunk, sample_maj=sample_maj)
     else:
-        snp_indices = get_snp_list(pfile_path, gwas_path, snp_count)
-        reader.read_list(snp_indices, array, sample_maj=True)
-    if missing == 'zero':
-        array[array < 0] = 0
-    elif missing == 'mean':
-        array = numpy.where(numpy.isnan(array), numpy.nanmean(array, axis=0), array) 
-    return array
+        reader.read_list(variant_indices, chunk, sample_maj=sample_maj)
+    return chunk
+
+
+def impute_mean_(variant_major: numpy.ndarray) -> None:
+    """Replaces missing (negative) genotypes of each SNP in-place with rounded mean of its non-missing genotypes 
+
+    Args:
+        variant_major (numpy.ndarray): int8 SNP-major genotype array, i.e. each row is a SNP
+    """    
+    missing_mask = variant_major < 0
+    observed = variant_major.shape[1] - missing_mask.sum(axis=1)
+    sums = numpy.where(missing_mask, 0, variant_major).sum(axis=1, dtype=numpy.int64)
+    means = numpy.rint(sums / numpy.maximum(observed, 1)).astype(numpy.int8)
+    numpy.copyto(variant_major, means[:, None], where=missing_mask)
 
 
 def load_phenotype(phenotype_path: str, out_type = numpy.float32, encode = False) -> numpy.ndarray:
@@ -82,21 +222,76 @@ def get_sample_indices(pfile_path: str, phenotype_path: str, indices_limit: Opti
         numpy.ndarray: Array with list of indices required to load samples present in
             the phenotype from the genotype file.
     """
-    psam = pandas.read_table(pfile_path + '.psam').rename(columns={'#IID': 'IID'})
-    pheno = pandas.read_table(phenotype_path)
-    psam['idx'] = numpy.arange(0, psam.shape[0])
-    indices = psam.loc[psam.IID.isin(pheno.IID), 'idx'].values.astype('uint32')
+    psam_iids = _read_psam_iids(pfile_path + '.psam')
+    pheno_iids = _read_phenotype_iids(phenotype_path)
+    indices = numpy.flatnonzero(numpy.isin(psam_iids, pheno_iids)).astype('uint32')
     if indices_limit is not None and indices_limit < indices.shape[0]:
         # we do not care about random subsample for now
         return indices[:indices_limit]
     else:
         return indices 
 
+@lru_cache(maxsize=16)
+def _read_psam_iids(psam_path: str) -> numpy.ndarray:
+    # .psam header is either '#IID ...' or '#FID IID ...'
+    iids = pandas.read_table(psam_path, usecols=lambda column: column in ['#IID', 'IID']).iloc[:, 0].to_numpy()
+    iids.flags.writeable = False
+    return iids
+
+
+@lru_cache(maxsize=16)
+def _read_phenotype_iids(phenotype_path: str) -> numpy.ndarray:
+    iids = pandas.read_table(phenotype_path, usecols=['IID'])['IID'].to_numpy()
+    iids.flags.writeable = False
+    return iids
+
+
+def read_columns(path: str, columns: List[str]) -> pandas.DataFrame:
+    """Reads only {columns} from tab-separated file. Uses multithreaded pyarrow parser if pyarrow is installed
+    and single-threaded pandas C parser otherwise
+
+    Args:
+        path (str): Path to tab-separated file with header
+        columns (List[str]): Columns to read
+
+    Returns:
+        pandas.DataFrame: DataFrame with {columns}
+    """    
+    if pyarrow_csv is None:
+        return pandas.read_table(path, usecols=columns, engine='c')
+    table = pyarrow_csv.read_csv(path, 
+                                 parse_options=pyarrow_csv.ParseOptions(delimiter='\t'), 
+                                 convert_options=pyarrow_csv.ConvertOptions(include_columns=columns))
+    return table.to_pandas()
+
+
+@lru_cache(maxsize=8)
+def get_top_snp_ids(gwas_path: str, snp_count: int) -> numpy.ndarray:
+    """Selects IDs of {snp_count} most significant SNPs from GWAS results. 
+    Results are cached because train, val and test genotypes are loaded with the same GWAS
+
+    Args:
+        gwas_path (str): Path to plink 2.0 GWAS results file generated by plink 2.0 --glm
+        snp_count (int): Number of SNPs to select
+
+    Returns:
+        numpy.ndarray: Read-only array of SNP IDs in arbitrary order
+    """    
+    gwas = read_columns(gwas_path, ['ID', 'LOG10_P'])
+    gwas_ids = gwas['ID'].to_numpy()
+    if snp_count < gwas_ids.shape[0]:
+        # O(n) partial selection of the most significant SNPs, full sort is not needed
+        top_indices = numpy.argpartition(-gwas['LOG10_P'].to_numpy(), snp_count - 1)[:snp_count]
+        gwas_ids = gwas_ids[top_indices]
+    # cached array is shared between callers
+    gwas_ids.flags.writeable = False
+    return gwas_ids
+
+
 def get_snp_list(pfile_path: str, gwas_path: str, snp_count: int) -> numpy.ndarray:
-    pvar = pandas.read_table(pfile_path + '.pvar')
-    gwas = pandas.read_table(gwas_path)
-    gwas.sort_values(by='LOG10_P', axis='index', ascending=False, inplace=True)
-    snp_ids = set(gwas.ID.values[:snp_count])
-    snp_indices = numpy.arange(pvar.shape[0])[pvar.ID.isin(snp_ids)].astype(numpy.uint32)
+    pvar = read_columns(pfile_path + '.pvar', ['ID'])
+    gwas_ids = get_top_snp_ids(gwas_path, snp_count)
+    mask = pvar['ID'].isin(gwas_ids).to_numpy()
+    snp_indices = numpy.flatnonzero(mask).astype(numpy.uint32)
     return snp_indices
     
@@ -0,0 +1,153 @@
+import os
+import numpy
+import pytest
+
+pytest.importorskip('pgenlib')
+from fl.datasets import memory
+from fl.datasets.memory import load_from_pgen
+
+
+class FakePgenReader:
+    # genotypes of all samples and variants, sample-major
+    genotypes: numpy.ndarray = None
+    # number of readers which were opened and not closed yet
+    open_count: int = 0
+
+    def __init__(self, path: bytes, sample_subset: numpy.ndarray = None) -> None:
+        FakePgenReader.open_count += 1
+        self.genotypes = FakePgenReader.genotypes if sample_subset is None else FakePgenReader.genotypes[sample_subset, :]
+
+    def get_raw_sample_ct(self) -> int:
+        return FakePgenReader.genotypes.shape[0]
+
+    def get_variant_ct(self) -> int:
+        return self.genotypes.shape[1]
+
+    def close(self) -> None:
+        FakePgenReader.open_count -= 1
+
+    def _write(self, variants: numpy.ndarray, out: numpy.ndarray, sample_maj: bool) -> None:
+        assert out.flags.c_contiguous
+        out[:] = variants if sample_maj else variants.T
+
+    def read_range(self, start: int, end: int, out: numpy.ndarray, sample_maj: bool = False) -> None:
+        self._write(self.genotypes[:, start:end], out, sample_maj)
+
+    def read_list(self, variant_indices: numpy.ndarray, out: numpy.ndarray, sample_maj: bool = False) -> None:
+        self._write(self.genotypes[:, variant_indices], out, sample_maj)
+
+
+@pytest.fixture
+def pfile(tmp_path, monkeypatch):
+    rng = numpy.random.default_rng(0)
+    FakePgenReader.genotypes = rng.choice(numpy.array([0, 1, 2, -9], dtype=numpy.int8), size=(9, 13))
+    FakePgenReader.open_count = 0
+    monkeypatch.setattr(memory, 'PgenReader', FakePgenReader)
+    pfile_path = str(tmp_path / 'genotypes')
+    with open(pfile_path + '.pgen', 'wb') as file:
+        file.write(b'pgen')
+    with open(pfile_path + '.pvar', 'w') as file:
+        file.write('#CHROM\tPOS\tID\n' + ''.join(f'1\t{i}\trs{i}\n' for i in range(13)))
+    gwas_path = str(tmp_path / 'gwas.tsv')
+    with open(gwas_path, 'w') as file:
+        # rs12, rs11, ... are the most significant SNPs
+        file.write('ID\tLOG10_P\n' + ''.join(f'rs{i}\t{i}\n' for i in range(13)))
+    return pfile_path, gwas_path
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 5, 13, 100])
+def test_load_from_pgen_missing_zero(pfile, chunk_size):
+    pfile_path, gwas_path = pfile
+    X = load_from_pgen(pfile_path, gwas_path, None, chunk_size=chunk_size)
+    expected = numpy.where(FakePgenReader.genotypes < 0, 0, FakePgenReader.genotypes)
+    assert X.dtype == numpy.int8
+    assert numpy.array_equal(X, expected)
+    assert FakePgenReader.open_count == 0
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 5, 100])
+def test_load_from_pgen_top_snps_and_samples(pfile, chunk_size):
+    pfile_path, gwas_path = pfile
+    sample_indices = numpy.array([1, 4, 8], dtype=numpy.uint32)
+    X = load_from_pgen(pfile_path, gwas_path, 5, sample_indices=sample_indices, chunk_size=chunk_size)
+    expected = FakePgenReader.genotypes[sample_indices][:, 8:]
+    assert numpy.array_equal(X, numpy.where(expected < 0, 0, expected))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 13])
+def test_load_from_pgen_missing_mean(pfile, chunk_size):
+    pfile_path, gwas_path = pfile
+    X = load_from_pgen(pfile_path, gwas_path, None, missing='mean', chunk_size=chunk_size)
+    genotypes = FakePgenReader.genotypes
+    assert X.shape == genotypes.shape
+    assert (X >= 0).all()
+    assert numpy.array_equal(X[genotypes >= 0], genotypes[genotypes >= 0])
+    for snp in range(genotypes.shape[1]):
+        observed = genotypes[genotypes[:, snp] >= 0, snp]
+        if 0 < len(observed) < genotypes.shape[0]:
+            assert (X[genotypes[:, snp] < 0, snp] == numpy.rint(observed.mean())).all()
+
+
+def test_load_from_pgen_snp_count_too_large(pfile):
+    pfile_path, gwas_path = pfile
+    with pytest.raises(ValueError):
+        load_from_pgen(pfile_path, gwas_path, 14)
+
+
+def test_impute_mean_():
+    variant_major = numpy.array([
+        [0, -9, 2, 2],
+        [1, 1, -9, -9],
+        [-9, -9, -9, -9],
+        [2, 0, 1, 1]
+    ], dtype=numpy.int8)
+    memory.impute_mean_(variant_major)
+    expected = numpy.array([
+        [0, 1, 2, 2],
+        [1, 1, 1, 1],
+        # SNP without observed genotypes is filled with 0
+        [0, 0, 0, 0],
+        [2, 0, 1, 1]
+    ], dtype=numpy.int8)
+    assert numpy.array_equal(variant_major, expected)
+
+
+def test_load_from_pgen_out_path_is_not_left_partial(pfile, tmp_path, monkeypatch):
+    pfile_path, gwas_path = pfile
+    out_path = str(tmp_path / 'genotypes.npy')
+
+    def failing_read_range(self, start, end, out, sample_maj=False):
+        if start > 0:
+            raise RuntimeError('read failed')
+        self._write(self.genotypes[:, start:end], out, sample_maj)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(FakePgenReader, 'read_range', failing_read_range)
+        with pytest.raises(RuntimeError):
+            load_from_pgen(pfile_path, gwas_path, None, chunk_size=4, out_path=out_path)
+    assert FakePgenReader.open_count == 0
+    assert not any(name.startswith('genotypes.npy') for name in os.listdir(tmp_path))
+
+    X = load_from_pgen(pfile_path, gwas_path, None, chunk_size=4, out_path=out_path)
+    assert not X.flags.writeable
+    assert numpy.array_equal(X, numpy.where(FakePgenReader.genotypes < 0, 0, FakePgenReader.genotypes))
+    # existing file is reused without reading .pgen
+    with monkeypatch.context() as patch:
+        patch.setattr(FakePgenReader, 'read_range', failing_read_range)
+        assert numpy.array_equal(load_from_pgen(pfile_path, gwas_path, None, chunk_size=4, out_path=out_path), X)
+
+
+def test_read_pgen_meta_detects_regenerated_pgen(pfile):
+    pfile_path, _ = pfile
+    assert memory.read_pgen_meta(pfile_path) == (9, 13)
+    FakePgenReader.genotypes = numpy.zeros((5, 20), dtype=numpy.int8)
+    with open(pfile_path + '.pgen', 'wb') as file:
+        file.write(b'regenerated pgen')
+    assert memory.read_pgen_meta(pfile_path) == (5, 20)
+
+
+def test_read_pgen_meta_ignores_malformed_sidecar(pfile):
+    pfile_path, _ = pfile
+    with open(pfile_path + '.meta.json', 'w') as file:
+        file.write('{"sample_count": 1')
+    assert memory.read_pgen_meta(pfile_path) == (9, 13)
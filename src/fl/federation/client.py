@@ -1,7 +1,8 @@
 from omegaconf import DictConfig
 import torch
 from logging import Logger
-from typing import Dict, OrderedDict, Tuple, Any
+from typing import Dict, List, Tuple, Any
+import numpy
 from pytorch_lightning.trainer import Trainer
 from pytorch_lightning.utilities.model_summary import _format_summary_table, summarize
 
@@ -81,6 +82,10 @@ class FLClient(NumPyClient):
         self.best_model_path = None
         self.node_params = node_params
         self.logger = logger
+        if self.node_params.get('allow_tf32', False):
+            # allows TensorFloat-32 tensor cores for fp32 matmuls on Ampere and newer GPUs
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
         self.log(f'cuda device count: {torch.cuda.device_count()}')
         self.log(f'training params are: {self.node_params.training}')
 
@@ -88,13 +93,17 @@ class FLClient(NumPyClient):
     def log(self, msg):
         self.logger.info(msg)
 
-    def get_parameters(self):
-        return [val.cpu().numpy() for _, val in self.model.state_dict().items()]
+    def get_parameters(self) -> List[numpy.ndarray]:
+        return [val.cpu().numpy() for val in self.model.state_dict().values()]
 
-    def set_parameters(self, parameters):
-        params_dict = zip(self.model.state_dict().keys(), parameters)
-        state_dict = OrderedDict({k: torch.Tensor(v) for k, v in params_dict if v.shape != ()})
-        self.model.load_state_dict(state_dict, strict=True)
+    def set_parameters(self, parameters: List[numpy.ndarray]):
+        state_dict = self.model.state_dict()
+        if len(parameters) != len(state_dict):
+            raise ValueError(f'got {len(parameters)} weight arrays but model state has {len(state_dict)} entries')
+        with torch.no_grad():
+            # state_dict tensors share storage with model parameters and buffers, so we update them in place
+            for val, weights in zip(state_dict.values(), parameters):
+                val.copy_(torch.from_numpy(weights))
 
     def fit(self, parameters, config):
         # self.log(f'started fitting with configs {configs}')
@@ -130,8 +139,10 @@ class FLClient(NumPyClient):
         start = time()                
         need_test_eval = 'current_round' in config and config['current_round'] == -1
         self.log(f'starting predict and eval with {need_test_eval}')
-        unreduced_metrics = self.model.predict_and_eval(self.data_module, 
-                                                        test=need_test_eval)
+        # forward-only pass, autograd bookkeeping is not needed
+        with torch.inference_mode():
+            unreduced_metrics = self.model.predict_and_eval(self.data_module, 
+                                                            test=need_test_eval)
         self.log('starting log to mlflow in eval')
         unreduced_metrics.log_to_mlflow()
         self.log(f'calculating val len')
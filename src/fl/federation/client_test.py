@@ -0,0 +1,43 @@
+import logging
+import numpy
+import pytest
+
+pytest.importorskip('pytorch_lightning')
+pytest.importorskip('flwr')
+from omegaconf import OmegaConf
+import nn.models
+from nn.lightning import DataModule
+from fl.federation.client import FLClient
+
+
+def test_fit_trains_max_epochs_every_round(tmp_path, monkeypatch):
+    epochs_in_round, rounds = 2, 3
+    node_params = OmegaConf.create({
+        'index': 0,
+        'model': {'name': 'linear_regressor', 'batch_size': 4, 'l1': 0.0},
+        'optimizer': {'name': 'sgd', 'lr': 1e-3},
+        'scheduler': {'rounds': rounds, 'epochs_in_round': epochs_in_round, 'gamma': 0.99},
+        'training': {
+            'max_epochs': epochs_in_round,
+            'enable_progress_bar': False,
+            'enable_model_summary': False,
+            'enable_checkpointing': False,
+            'num_sanity_val_steps': 0,
+            'default_root_dir': str(tmp_path)
+        }
+    })
+    rng = numpy.random.default_rng(0)
+    X = rng.random((24, 3)).astype(numpy.float32)
+    y = rng.random(24).astype(numpy.float32)
+    data_module = DataModule(X[:16], X[16:20], X[20:], y[:16], y[16:20], y[20:], batch_size=4)
+
+    train_epochs = []
+    monkeypatch.setattr(nn.models, 'log_metrics_async',
+                        lambda metrics, step: train_epochs.append(step) if 'train_loss' in metrics else None)
+    client = FLClient('', data_module, node_params, logging.getLogger(__name__))
+    parameters = client.get_parameters()
+    for current_round in range(1, rounds + 1):
+        start = len(train_epochs)
+        parameters, _, _ = client.fit(parameters, {'current_round': current_round})
+        first_epoch = (current_round - 1)*epochs_in_round
+        assert train_epochs[start:] == list(range(first_epoch, first_epoch + epochs_in_round))
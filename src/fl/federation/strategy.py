@@ -1,5 +1,3 @@
-import pickle
-import shutil
 from typing import List, Tuple, Optional, Dict
 import logging
 import numpy
@@ -19,7 +17,7 @@ from flwr.server.client_proxy import ClientProxy
 from flwr.server.strategy import FedAvg, FedAdam, FedAdagrad, QFedAvg
 from flwr.server.client_manager import ClientManager
 
-from nn.utils import LassoNetRegMetrics, Metrics, RegFederatedMetrics
+from nn.utils import LassoNetRegMetrics, Metrics, RegFederatedMetrics, unpack_metrics
 
 
 def fit_round(rnd: int):
@@ -54,7 +52,7 @@ class MlflowLogger:
         Returns:
             Metrics: Metrics reduced over clients
         """       
-        metric_list = [pickle.loads(r[1].metrics['metrics']) for r in results]
+        metric_list = [unpack_metrics(r[1].metrics) for r in results]
         fed_metrics = RegFederatedMetrics(metric_list, rnd*self.epochs_in_round)
         # LassoNetRegMetrics averaged by clients axis, i.e. one aggregated metric value for each alpha value
         # Other metrics are averaged by client axis but have only one value in total for train, val, test datasets
@@ -78,6 +76,8 @@ class Checkpointer:
         self.history = []
         self.best_metrics = None
         self.last_metrics = None
+        # weights of the best model are kept in memory and written to disk only by copy_best_model
+        self.best_weights: Optional[Weights] = None
 
     def add_loss_to_history(self, metrics: Metrics) -> None:
         self.history.append(metrics.val_loss)
@@ -87,7 +87,7 @@ class Checkpointer:
             self.best_metrics = metrics
 
     def save_checkpoint(self, rnd: int, aggregated_parameters: Parameters) -> None:
-        """Checks if current model has minimum loss and if so, saves it to 'best_temp_model.ckpt'
+        """Checks if current model has minimum loss and if so, keeps its weights as the best ones
 
         Args:
             rnd (int): Current FL round
@@ -95,19 +95,22 @@ class Checkpointer:
         """        
         if aggregated_parameters is not None:
             if len(self.history) == 0 or (len(self.history) > 0 and self.history[-1] == min(self.history)):
-                # Save aggregated_weights
-                aggregated_weights = parameters_to_weights(aggregated_parameters)
                 # print(f"round {rnd}\tmin_val_loss: {self.history[-1]:.2f}\tsaving_checkpoint to {self.checkpoint_dir}")
-                numpy.savez(os.path.join(self.checkpoint_dir, f'best_temp_model.ckpt'), *aggregated_weights)
+                self.best_weights = parameters_to_weights(aggregated_parameters)
         else:
             pass
     
     def load_best_parameters(self) -> Parameters:
-        weights = list(numpy.load(os.path.join(self.checkpoint_dir, f'best_temp_model.ckpt.npz')).values())
-        return weights_to_parameters(weights)
+        if self.best_weights is None:
+            raise RuntimeError('best model weights are not saved yet, save_checkpoint should be called first')
+        return weights_to_parameters(self.best_weights)
     
     def copy_best_model(self, best_model_path: str):
-        shutil.copy2(os.path.join(self.checkpoint_dir, f'best_temp_model.ckpt.npz'), best_model_path)
+        if self.best_weights is None:
+            raise RuntimeError('best model weights are not saved yet, save_checkpoint should be called first')
+        # file object is used to write exactly to {best_model_path}, numpy.savez appends .npz to str paths
+        with open(best_model_path, 'wb') as file:
+            numpy.savez(file, *self.best_weights)
 
 
 class MCMixin:
@@ -50,9 +50,10 @@ class BaseNet(LightningModule):
         return {'val_loss': loss, 'batch_len': x.shape[0]}
 
     def calculate_avg_epoch_metric(self, outputs: List[Dict[str, Any]], metric_name: str) -> float:
-        total_len = sum(out['batch_len'] for out in outputs)
-        avg_loss = sum(out[metric_name].item()*out['batch_len'] for out in outputs)/total_len
-        return avg_loss
+        # weighted average is calculated on device to synchronize with host only once per epoch
+        metrics = torch.stack([out[metric_name].detach() for out in outputs]).double()
+        batch_lens = torch.tensor([out['batch_len'] for out in outputs], device=metrics.device, dtype=metrics.dtype)
+        return ((metrics*batch_lens).sum()/batch_lens.sum()).item()
 
     def training_epoch_end(self, outputs: List[Dict[str, Any]]) -> None:
         avg_loss = self.calculate_avg_epoch_metric(outputs, 'loss')
@@ -139,7 +140,7 @@ class LinearClassifier(BaseNet):
 
     def validation_epoch_end(self, outputs: List[Dict[str, Any]]) -> None:
         avg_loss = self.calculate_avg_epoch_metric(outputs, 'val_loss')
-        avg_accuracy = self.calculate_avg_val_accuracy(outputs, 'val_accuracy')
+        avg_accuracy = self.calculate_avg_epoch_metric(outputs, 'val_accuracy')
         self.log('val_loss', avg_loss)
         self.log('val_accuracy', avg_accuracy)
 
@@ -17,6 +17,7 @@ from sklearn.linear_model import LinearRegression
 
 from fl.datasets.memory import load_from_pgen, load_phenotype, load_covariates, get_sample_indices
 from nn.lightning import DataModule
+from nn.utils import flush_metrics
 from fl.federation.client import FLClient
 from configs.phenotype_config import MEAN_PHENO_DICT
 
@@ -31,6 +32,8 @@ class TrainerInfo:
     devices: Union[List[int], int]
     accelerator: str
     node_index: int
+    # number of DataLoader worker processes
+    num_workers: int = 0
 
     def to_dotlist(self) -> List[str]:
         return [f'node.index={self.node_index}', f'node.training.devices={self.devices}', f'node.training.accelerator={self.accelerator}']
@@ -148,7 +151,9 @@ class Node(Process):
         self.sample_count = X_train.shape[0]
 
         data_module = DataModule(X_train, X_val, X_test, self.y_train, self.y_val, self.y_test, self.cfg.node.model.batch_size,
-                                 X_cov_train, X_cov_val, X_cov_test)
+                                 X_cov_train, X_cov_val, X_cov_test, 
+                                 packed=self.cfg.experiment.get('packed_genotypes', False),
+                                 num_workers=self.trainer_info.num_workers)
         return data_module
 
     def _pretrain(self) -> numpy.ndarray:
@@ -220,4 +225,5 @@ class Node(Process):
                 cov_weights = self._pretrain() 
                 client.model.set_covariate_weights(cov_weights)
             self._train_model(client)
+            flush_metrics()
             
\ No newline at end of file
@@ -10,6 +10,7 @@ import logging
 
 from fl.node_process import MlflowInfo, Node, TrainerInfo
 from fl.server_process import Server
+from nn.utils import enable_mlflow_keep_alive
 
 
 # necessary to add cwd to path when script run 
@@ -20,7 +21,8 @@ sys.path.append(os.getcwd())
 
 def get_cfg_hash(cfg: DictConfig):
     yaml_representation = OmegaConf.to_yaml(cfg)
-    return hashlib.sha224(yaml_representation.encode()).hexdigest()
+    # non-cryptographic use, digest size matches the previous sha224 hash length
+    return hashlib.blake2b(yaml_representation.encode(), digest_size=28).hexdigest()
 
 
 def configure_logging():
@@ -43,6 +45,22 @@ def get_active_nodes(cfg: DictConfig):
     return active_nodes
 
 
+def get_node_cpus(node_info: DictConfig, node_count: int) -> int:
+    """Returns number of cpus for node, explicit node resources take precedence over even share of slurm job cpus
+
+    Args:
+        node_info (DictConfig): Node entry of split configs
+        node_count (int): Number of active nodes in the job
+
+    Returns:
+        int: Number of cpus, at least 1
+    """    
+    if 'cpus' in node_info.resources:
+        return int(node_info.resources.cpus)
+    job_cpus = int(os.environ.get('SLURM_CPUS_PER_TASK', node_count))
+    return max(1, job_cpus // node_count)
+
+
 @hydra.main(config_path='configs', config_name='default')
 def run(cfg: DictConfig):
     
@@ -57,6 +75,8 @@ def run(cfg: DictConfig):
     mlflow_url = os.environ.get('MLFLOW_TRACKING_URI', './mlruns')
     print(f'logging mlflow data to server {mlflow_url}')
     
+    # node and server processes are forked after this and inherit pooled connections setting
+    enable_mlflow_keep_alive()
     experiment = mlflow.set_experiment(cfg.experiment.name)
 
     params_hash = get_cfg_hash(cfg)
@@ -81,11 +101,13 @@ def run(cfg: DictConfig):
         node_processes = []
         for node_info in active_nodes:
             need_gpu = node_info.resources.get('gpus', 0)
+            # one cpu is left for the node process itself
+            num_workers = get_node_cpus(node_info, len(active_nodes)) - 1
             if need_gpu:
                 gpu_index += 1
-                trainer_info = TrainerInfo([gpu_index], 'gpu', node_info.index)
+                trainer_info = TrainerInfo([gpu_index], 'gpu', node_info.index, num_workers)
             else:
-                trainer_info = TrainerInfo(1, 'cpu', node_info.index)
+                trainer_info = TrainerInfo(1, 'cpu', node_info.index, num_workers)
             node = Node(server_url, log_dir, info, queue, cfg, trainer_info)
             node.start()
             print(f'starting node {node_info.index}, name: {node_info.name}')
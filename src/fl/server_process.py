@@ -7,6 +7,7 @@ import numpy
 from flwr.server import start_server
 from flwr.server.strategy import FedAvg
 
+from nn.utils import flush_metrics
 from fl.federation.strategy import Checkpointer, MCFedAvg, MCFedAdagrad, MCFedAdam, MCQFedAvg, MlflowLogger, fit_round, on_evaluate_config_fn
 
 
@@ -88,5 +89,6 @@ class Server(Process):
                     config={"num_rounds": self.cfg.server.rounds},
                     force_final_distributed_eval=True
         )
+        flush_metrics()
     
         strategy.checkpointer.copy_best_model(os.path.join(self.cfg.server.checkpoint_dir, self.params_hash, 'best_model.ckpt'))
\ No newline at end of file
@@ -1,11 +1,14 @@
 from abc import abstractmethod
+import hashlib
+import os
 
 import hydra
 import logging
 from sys import stdout
 import numpy
 import pandas as pd
-from omegaconf import DictConfig
+from omegaconf import DictConfig, OmegaConf
+import psutil
 import mlflow
 from mlflow.xgboost import autolog
 from mlflow.types import Schema, TensorSpec
@@ -21,6 +24,7 @@ from local.config import node_size_dict, node_name_dict
 from fl.datasets.memory import load_covariates, load_phenotype, load_from_pgen, get_sample_indices
 from nn.lightning import DataModule
 from nn.train import prepare_trainer
+from nn.utils import enable_mlflow_keep_alive
 from nn.models import MLPPredictor, LassoNetRegressor, MLPClassifier
 from configs.phenotype_config import MEAN_PHENO_DICT, PHENO_TYPE_DICT, PHENO_NUMPY_DICT, TYPE_LOSS_DICT, \
     TYPE_METRIC_DICT
@@ -70,6 +74,7 @@ class LocalExperiment(object):
             }
         else:
             raise ValueError('Please define the study in config! See src/configs/default.yaml')
+        enable_mlflow_keep_alive()
         self.run = mlflow.start_run(tags=universal_tags | study_tags)
 
     def load_data(self):
@@ -106,7 +111,14 @@ class LocalExperiment(object):
         else:
             raise ValueError('Please define the study in config! See src/configs/default.yaml')
 
+        self.X_train, self.X_val, self.X_test = map(self.convert_features, [self.X_train, self.X_val, self.X_test])
         self.logger.info(f"{self.X_train.shape[1]} features loaded")
+
+    def convert_features(self, X):
+        """Converts features into the dtype and memory layout expected by the model, so that it does not copy them on fit and predict.
+        Default implementation returns {X} unchanged
+        """        
+        return X
         
     def load_sample_indices(self):
         self.logger.info("Loading sample indices")
@@ -119,37 +131,50 @@ class LocalExperiment(object):
                                                       self.cfg.data.phenotype.test,
                                                       indices_limit=test_samples_limit)
         
+    def _stack_features(self, genotype: numpy.ndarray, covariates: numpy.ndarray) -> numpy.ndarray:
+        # features stay dense for every model: XGBoost treats entries absent from a sparse matrix as missing, 
+        # not as homozygous reference genotype 0
+        return hstack((genotype, covariates.astype(numpy.float16)))
+
     def load_genotype_and_covariates_(self):
         test_samples_limit = self.cfg.experiment.get('test_samples_limit', None)
-        self.X_train = hstack((load_from_pgen(self.cfg.data.genotype.train,
-                                              self.cfg.data.gwas,
-                                              snp_count=self.cfg.experiment.snp_count,
-                                              sample_indices=self.sample_indices_train),
-                               load_covariates(self.cfg.data.covariates.train).astype(numpy.float16)))
-        self.X_val = hstack((load_from_pgen(self.cfg.data.genotype.val,
-                                              self.cfg.data.gwas,
-                                              snp_count=self.cfg.experiment.snp_count,
-                                              sample_indices=self.sample_indices_val),
-                               load_covariates(self.cfg.data.covariates.val).astype(numpy.float16)))
-        self.X_test = hstack((load_from_pgen(self.cfg.data.genotype.test,
-                                              self.cfg.data.gwas,
-                                              snp_count=self.cfg.experiment.snp_count,
-                                              sample_indices=self.sample_indices_test),
-                               load_covariates(self.cfg.data.covariates.test)[:test_samples_limit, :].astype(numpy.float16)))
+        self.X_train = self._stack_features(self._load_genotype(self.cfg.data.genotype.train, self.sample_indices_train),
+                                            load_covariates(self.cfg.data.covariates.train))
+        self.X_val = self._stack_features(self._load_genotype(self.cfg.data.genotype.val, self.sample_indices_val),
+                                          load_covariates(self.cfg.data.covariates.val))
+        self.X_test = self._stack_features(self._load_genotype(self.cfg.data.genotype.test, self.sample_indices_test),
+                                           load_covariates(self.cfg.data.covariates.test)[:test_samples_limit, :])
         
     def load_genotype_(self):
-        self.X_train = load_from_pgen(self.cfg.data.genotype.train,
-                                      gwas_path=self.cfg.data.get('gwas', None),
-                                      snp_count=self.cfg.experiment.get('snp_count', None),
-                                      sample_indices=self.sample_indices_train)
-        self.X_val = load_from_pgen(self.cfg.data.genotype.val,
-                                    gwas_path=self.cfg.data.get('gwas', None),
-                                    snp_count=self.cfg.experiment.get('snp_count', None),
-                                    sample_indices=self.sample_indices_val)
-        self.X_test = load_from_pgen(self.cfg.data.genotype.test,
-                                     gwas_path=self.cfg.data.get('gwas', None),
-                                     snp_count=self.cfg.experiment.get('snp_count', None),
-                                     sample_indices=self.sample_indices_test)
+        self.X_train = self._load_genotype(self.cfg.data.genotype.train, self.sample_indices_train)
+        self.X_val = self._load_genotype(self.cfg.data.genotype.val, self.sample_indices_val)
+        self.X_test = self._load_genotype(self.cfg.data.genotype.test, self.sample_indices_test)
+
+    def _load_genotype(self, pfile_path: str, sample_indices: numpy.ndarray) -> numpy.ndarray:
+        """Loads genotypes of {sample_indices} samples. If experiment.genotype_cache_dir is set, 
+        genotypes are decoded into a .npy file there once and memory-mapped read-only afterwards, 
+        so that runs on the same data share OS page cache instead of decoding .pgen into private memory
+
+        Args:
+            pfile_path (str): Path to plink 2.0 .pgen, .pvar, .psam dataset without extension
+            sample_indices (numpy.ndarray): Indices of samples in .psam
+
+        Returns:
+            numpy.ndarray: An int8 sample-major genotype array, numpy.memmap if cache is enabled
+        """        
+        gwas_path = self.cfg.data.get('gwas', None)
+        snp_count = self.cfg.experiment.get('snp_count', None)
+        cache_dir = self.cfg.experiment.get('genotype_cache_dir', None)
+        out_path = None
+        if cache_dir is not None:
+            # size and mtime of inputs invalidate the cache when .pgen, .pvar or GWAS are regenerated at the same path
+            source_paths = [pfile_path + '.pgen', pfile_path + '.pvar'] + ([gwas_path] if gwas_path is not None else [])
+            versions = [f'{stat.st_size}:{stat.st_mtime_ns}' for stat in map(os.stat, source_paths)]
+            key = hashlib.blake2b(f'{pfile_path}:{gwas_path}:{snp_count}:{versions}'.encode(), digest_size=16)
+            key.update(numpy.ascontiguousarray(sample_indices).tobytes())
+            os.makedirs(cache_dir, exist_ok=True)
+            out_path = os.path.join(cache_dir, f'{os.path.basename(pfile_path)}_{key.hexdigest()}.npy')
+        return load_from_pgen(pfile_path, gwas_path, snp_count=snp_count, sample_indices=sample_indices, out_path=out_path)
 
     def load_covariates_(self):
         test_samples_limit = self.cfg.experiment.get('test_samples_limit', None)
@@ -161,22 +186,25 @@ class LocalExperiment(object):
     def train(self):
         pass
         
-    def eval_and_log(self):
+    def eval_and_log(self, metric_fun=r2_score, metric_name='r2'):
         self.logger.info("Evaluating model")
         preds_train = self.model.predict(self.X_train)
         preds_val = self.model.predict(self.X_val)
         preds_test = self.model.predict(self.X_test)
 
-        r2_train = r2_score(self.y_train, preds_train)
-        r2_val = r2_score(self.y_val, preds_val)
-        r2_test = r2_score(self.y_test, preds_test)
+        metric_train = metric_fun(y_true=self.y_train, y_pred=preds_train)
+        metric_val = metric_fun(y_true=self.y_val, y_pred=preds_val)
+        metric_test = metric_fun(y_true=self.y_test, y_pred=preds_test)
         
-        print(f"Train r2: {r2_train}")
-        mlflow.log_metric('train_r2', r2_train)
-        print(f"Val r2: {r2_val}")
-        mlflow.log_metric('val_r2', r2_val)
-        print(f"Test r2: {r2_test}")
-        mlflow.log_metric('test_r2', r2_test)
+        print(f"Train {metric_name}: {metric_train}")
+        print(f"Val {metric_name}: {metric_val}")
+        print(f"Test {metric_name}: {metric_test}")
+        # one log_batch request instead of a request per metric
+        mlflow.log_metrics({
+            f'train_{metric_name}': metric_train, 
+            f'val_{metric_name}': metric_val, 
+            f'test_{metric_name}': metric_test
+        })
     
     def run(self):
         self.load_sample_indices()
@@ -199,6 +227,11 @@ def simple_estimator_factory(model):
             LocalExperiment.__init__(self, cfg)
             self.model = model(**self.cfg.model.params)
 
+        def convert_features(self, X):
+            # coordinate descent of sklearn linear models works on columns and accepts float32, 
+            # genotypes 0, 1, 2 are represented exactly
+            return numpy.asfortranarray(X, dtype=numpy.float32)
+
         def train(self):
             self.logger.info("Training")
             self.model.fit(self.X_train, self.y_train)
@@ -206,15 +239,23 @@ def simple_estimator_factory(model):
     return SimpleEstimatorExperiment
 
 class XGBExperiment(LocalExperiment):
+    def convert_features(self, X):
+        # XGBoost stores features as float32 and copies any other input
+        return numpy.ascontiguousarray(X, dtype=numpy.float32)
+
     def __init__(self, cfg):
         LocalExperiment.__init__(self, cfg)
-        self.model = XGBRegressor(**self.cfg.model.params)
+        params = OmegaConf.to_container(self.cfg.model.params, resolve=True)
+        # CPUs allotted to the job (e.g. SLURM --cpus-per-task), hyperthreads beyond physical cores only add contention
+        params.setdefault('n_jobs', min(len(os.sched_getaffinity(0)), psutil.cpu_count(logical=False) or 1))
+        self.model = XGBRegressor(**params)
 
     def train(self):
         self.logger.info("Training")
-        autolog()
+        # per-iteration eval metrics are still logged by autolog in batches, printing them is redundant
+        autolog(silent=True)
         self.model.fit(self.X_train, self.y_train, eval_set=[(self.X_val, self.y_val)],
-                       early_stopping_rounds=self.cfg.model.early_stopping_rounds, verbose=True)
+                       early_stopping_rounds=self.cfg.model.early_stopping_rounds, verbose=False)
 
 class NNExperiment(LocalExperiment):
     def __init__(self, cfg):
@@ -222,11 +263,15 @@ class NNExperiment(LocalExperiment):
 
     def load_data(self):
         LocalExperiment.load_data(self)
+        packed = self.cfg.experiment.get('packed_genotypes', False)
+        if packed and self.X_train.dtype != numpy.int8:
+            raise ValueError('packed_genotypes requires int8 genotypes only, disable include_covariates or packed_genotypes')
         self.data_module = DataModule(self.X_train, self.X_val, self.X_test,
                                       self.y_train.astype(PHENO_NUMPY_DICT[self.cfg.phenotype.name]),
                                       self.y_val.astype(PHENO_NUMPY_DICT[self.cfg.phenotype.name]),
                                       self.y_test.astype(PHENO_NUMPY_DICT[self.cfg.phenotype.name]),
-                                      batch_size=self.cfg.model.get('batch_size', len(self.X_train)))
+                                      batch_size=self.cfg.model.get('batch_size', len(self.X_train)),
+                                      packed=packed)
     
     def create_model(self):
         if self.cfg.study == 'tg':
@@ -293,11 +338,13 @@ class NNExperiment(LocalExperiment):
         metric_test = metric_fun(y_true=self.y_test, y_pred=test_preds)
         
         print(f"Train {metric_name}: {metric_train}")
-        mlflow.log_metric(f'train_{metric_name}', metric_train)
         print(f"Val {metric_name}: {metric_val}")
-        mlflow.log_metric(f'val_{metric_name}', metric_val)
         print(f"Test {metric_name}: {metric_test}")
-        mlflow.log_metric(f'test_{metric_name}', metric_test)
+        mlflow.log_metrics({
+            f'train_{metric_name}': metric_train, 
+            f'val_{metric_name}': metric_val, 
+            f'test_{metric_name}': metric_test
+        })
 
 
 class LassoNetExperiment(NNExperiment):
@@ -360,7 +407,7 @@ class LassoNetExperiment(NNExperiment):
         print(f'Loaded best model {self.trainer.checkpoint_callback.best_model_path}')
 
     
-    def eval_and_log(self):
+    def eval_and_log(self, metric_fun=r2_score, metric_name='r2'):
         if self.cfg.experiment.get('log_model', None):
             self.logger.info("Logging model")
             input_schema = Schema([
@@ -395,11 +442,9 @@ class LassoNetExperiment(NNExperiment):
         
         print(f'Best alpha: {self.model.alphas[best_col]:.6f}')
         print(f"Train r2: {best_train_r2:.4f}")
-        mlflow.log_metric('train_r2', best_train_r2)
         print(f"Val r2: {best_val_r2:.4f}")
-        mlflow.log_metric('val_r2', best_val_r2)
         print(f"Test r2: {best_test_r2:.4f}")
-        mlflow.log_metric('test_r2', best_test_r2)
+        mlflow.log_metrics({'train_r2': best_train_r2, 'val_r2': best_val_r2, 'test_r2': best_test_r2})
         
         
 # Dict of possible experiment types and their corresponding classes
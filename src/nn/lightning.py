@@ -1,9 +1,10 @@
 from typing import List
 import numpy
+import torch
 from pytorch_lightning import LightningDataModule
 from torch.utils.data import TensorDataset, DataLoader
 
-from .memory import XyCovDataset
+from .memory import XyCovDataset, PackedXyCovDataset
 
 
 NArr = numpy.ndarray
@@ -12,27 +13,34 @@ NArr = numpy.ndarray
 class DataModule(LightningDataModule):
     def __init__(self, X_train: NArr, X_val: NArr, X_test: NArr, 
                  y_train: NArr, y_val: NArr, y_test: NArr, batch_size: int,
-                 X_cov_train: NArr = None, X_cov_val: NArr = None, X_cov_test: NArr = None):
+                 X_cov_train: NArr = None, X_cov_val: NArr = None, X_cov_test: NArr = None, packed: bool = False,
+                 num_workers: int = 0):
         super().__init__()
-        self.train_dataset = XyCovDataset(X_train, y_train, X_cov_train)
-        self.val_dataset = XyCovDataset(X_val, y_val, X_cov_val)
-        self.test_dataset = XyCovDataset(X_test, y_test, X_cov_test)
+        # packed datasets keep genotypes in 2 bits and decode them per sample
+        dataset_cls = PackedXyCovDataset if packed else XyCovDataset
+        self.train_dataset = dataset_cls(X_train, y_train, X_cov_train)
+        self.val_dataset = dataset_cls(X_val, y_val, X_cov_val)
+        self.test_dataset = dataset_cls(X_test, y_test, X_cov_test)
         self.batch_size = batch_size
+        # pinned batches are copied to gpu asynchronously
+        self.pin_memory = torch.cuda.is_available()
+        self.num_workers = num_workers
+
+    def _dataloader(self, dataset: XyCovDataset, shuffle: bool) -> DataLoader:
+        return DataLoader(dataset, batch_size=self.batch_size, shuffle=shuffle, 
+                          num_workers=self.num_workers, pin_memory=self.pin_memory)
 
     def train_dataloader(self) -> DataLoader:
-        loader = DataLoader(self.train_dataset, batch_size=self.batch_size, shuffle=True, num_workers=0)
-        return loader
+        return self._dataloader(self.train_dataset, shuffle=True)
     
     def val_dataloader(self) -> DataLoader:
-        loader = DataLoader(self.val_dataset, batch_size=self.batch_size, shuffle=False, num_workers=0)
-        return loader
+        return self._dataloader(self.val_dataset, shuffle=False)
     
     def test_dataloader(self) -> DataLoader:
-        loader = DataLoader(self.test_dataset, batch_size=self.batch_size, shuffle=False, num_workers=0)
-        return loader
+        return self._dataloader(self.test_dataset, shuffle=False)
 
     def predict_dataloader(self) -> List[DataLoader]:
-        train_loader = DataLoader(self.train_dataset, batch_size=self.batch_size, shuffle=False, num_workers=0)
+        train_loader = self._dataloader(self.train_dataset, shuffle=False)
         val_loader = self.val_dataloader()
         test_loader = self.test_dataloader()
         return [train_loader, val_loader, test_loader]
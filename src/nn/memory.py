@@ -2,6 +2,41 @@ import numpy
 from typing import Tuple
 
 
+# each byte stores four 2-bit genotype codes, missing genotypes are stored as 0b11 and decoded as 0
+_UNPACK_TABLE = numpy.array([[(byte >> (2*k)) & 0x3 for k in range(4)] for byte in range(256)], dtype=numpy.float32)
+_UNPACK_TABLE[_UNPACK_TABLE == 3] = 0
+
+
+def pack_genotypes(X: numpy.ndarray) -> numpy.ndarray:
+    """Packs four genotypes from {0, 1, 2, missing} into each byte
+
+    Args:
+        X (numpy.ndarray): int8 sample-major genotype array, negative values are treated as missing
+
+    Returns:
+        numpy.ndarray: uint8 array of shape (sample_count, ceil(snp_count/4))
+    """
+    sample_count, snp_count = X.shape
+    codes = numpy.zeros((sample_count, (snp_count + 3) // 4 * 4), dtype=numpy.uint8)
+    codes[:, :snp_count] = numpy.bitwise_and(X, 0x3)
+    codes = codes.reshape(sample_count, -1, 4)
+    return codes[:, :, 0] | (codes[:, :, 1] << 2) | (codes[:, :, 2] << 4) | (codes[:, :, 3] << 6)
+
+
+def unpack_genotypes(packed: numpy.ndarray, snp_count: int) -> numpy.ndarray:
+    """Decodes genotypes packed by pack_genotypes into float32 array
+
+    Args:
+        packed (numpy.ndarray): Packed genotypes of one sample or a batch of samples
+        snp_count (int): Number of SNPs before packing
+
+    Returns:
+        numpy.ndarray: float32 array with {snp_count} genotypes in the last axis
+    """
+    unpacked = _UNPACK_TABLE[packed]
+    return unpacked.reshape(*packed.shape[:-1], -1)[..., :snp_count]
+
+
 class XyCovDataset:
     def __init__(self, X: numpy.ndarray, y: numpy.ndarray, X_cov: numpy.ndarray = None) -> None:
         self.X = X
@@ -16,9 +51,32 @@ class XyCovDataset:
             return numpy.hstack([self.X[idx, :].astype(numpy.float32), self.X_cov[idx, :].astype(numpy.float32)]), self.y[idx]
         else:
             return self.X[idx, :].astype(numpy.float32), self.y[idx]
-    
+
     def feature_count(self) -> int:
         return self.X.shape[1] if self.X_cov is None else self.X.shape[1] + self.X_cov.shape[1]
 
     def covariate_count(self) -> int:
-        return self.X_cov.shape[1] if self.X_cov is not None else 0
\ No newline at end of file
+        return self.X_cov.shape[1] if self.X_cov is not None else 0
+
+
+class PackedXyCovDataset(XyCovDataset):
+    def __init__(self, X: numpy.ndarray, y: numpy.ndarray, X_cov: numpy.ndarray = None) -> None:
+        """Stores genotypes packed into 2 bits and decodes them on access, uses 4x less memory than XyCovDataset
+
+        Args:
+            X (numpy.ndarray): int8 sample-major genotype array
+            y (numpy.ndarray): Phenotypes
+            X_cov (numpy.ndarray, optional): Covariates. Defaults to None.
+        """
+        super().__init__(pack_genotypes(X), y, X_cov)
+        self.snp_count = X.shape[1]
+
+    def __getitem__(self, idx: int) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        x = unpack_genotypes(self.X[idx, :], self.snp_count)
+        if self.X_cov is not None:
+            return numpy.hstack([x, self.X_cov[idx, :].astype(numpy.float32)]), self.y[idx]
+        else:
+            return x, self.y[idx]
+
+    def feature_count(self) -> int:
+        return self.snp_count + self.covariate_count()
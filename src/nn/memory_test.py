@@ -0,0 +1,34 @@
+import numpy
+import pytest
+from nn.memory import pack_genotypes, unpack_genotypes, XyCovDataset, PackedXyCovDataset
+
+
+@pytest.mark.parametrize('snp_count', [1, 3, 4, 5, 8, 11])
+def test_pack_unpack_genotypes(snp_count):
+    rng = numpy.random.default_rng(0)
+    X = rng.choice(numpy.array([0, 1, 2, -9], dtype=numpy.int8), size=(7, snp_count))
+    packed = pack_genotypes(X)
+    assert packed.dtype == numpy.uint8
+    assert packed.shape == (7, (snp_count + 3) // 4)
+    unpacked = unpack_genotypes(packed, snp_count)
+    assert unpacked.dtype == numpy.float32
+    # missing genotypes are decoded as 0
+    assert numpy.array_equal(unpacked, numpy.where(X < 0, 0, X).astype(numpy.float32))
+    assert numpy.array_equal(unpack_genotypes(packed[2], snp_count), unpacked[2])
+
+
+def test_PackedXyCovDataset_matches_XyCovDataset():
+    rng = numpy.random.default_rng(1)
+    X = rng.choice(numpy.array([0, 1, 2], dtype=numpy.int8), size=(5, 9))
+    y = rng.random(5).astype(numpy.float32)
+    X_cov = rng.random((5, 2)).astype(numpy.float32)
+    dataset = XyCovDataset(X, y, X_cov)
+    packed_dataset = PackedXyCovDataset(X, y, X_cov)
+    assert len(packed_dataset) == len(dataset)
+    assert packed_dataset.feature_count() == dataset.feature_count() == 11
+    assert packed_dataset.covariate_count() == 2
+    for idx in range(len(dataset)):
+        x, target = dataset[idx]
+        packed_x, packed_target = packed_dataset[idx]
+        assert numpy.array_equal(packed_x, x)
+        assert packed_target == target
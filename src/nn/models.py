@@ -7,10 +7,19 @@ from torch.nn.init import uniform_ as init_uniform_
 from torch.nn.functional import mse_loss, binary_cross_entropy_with_logits, relu, softmax
 from torch.utils.data import DataLoader
 from torchmetrics import R2Score
-import mlflow
 
 from nn.lightning import DataModule
-from nn.utils import LassoNetRegMetrics, Metrics, RegLoaderMetrics, RegMetrics
+from nn.utils import LassoNetRegMetrics, Metrics, RegLoaderMetrics, RegMetrics, log_metrics_async
+
+
+def soft_threshold_(weight: torch.Tensor, threshold: Any) -> None:
+    """In-place proximal operator of l1 norm, shrinks {weight} towards zero by {threshold}
+
+    Args:
+        weight (torch.Tensor): Weights to shrink
+        threshold (Any): Scalar or tensor broadcastable to {weight}
+    """    
+    weight.copy_(torch.sign(weight) * torch.clamp(weight.abs() - threshold, min=0))
 
 
 class BaseNet(LightningModule):
@@ -26,11 +35,15 @@ class BaseNet(LightningModule):
         self.optim_params = optim_params
         self.scheduler_params = scheduler_params
         self.current_round = 1
+        # if True, l1 penalty is applied by proximal step after each optimizer step instead of adding it to the loss
+        self.proximal_l1 = optim_params.get('proximal_l1', False)
 
     def training_step(self, batch: Tuple[torch.Tensor, torch.Tensor], batch_idx: int) -> Dict[str, Any]:
         x, y = batch
         y_hat = self(x)
         raw_loss = self.calculate_loss(y_hat, y)
+        if self.proximal_l1:
+            return {'loss': raw_loss, 'raw_loss': raw_loss.detach(), 'batch_len': x.shape[0]}
         reg = self.regularization()
         loss = raw_loss + reg
         return {'loss': loss, 'raw_loss': raw_loss.detach(), 'reg': reg.detach(), 'batch_len': x.shape[0]}
@@ -41,6 +54,14 @@ class BaseNet(LightningModule):
     def regularization(self) -> torch.Tensor:
         raise NotImplementedError('subclasses of BaseNet should implement regularization')
 
+    def proximal_step(self, lr: float) -> None:
+        raise NotImplementedError('subclasses of BaseNet should implement proximal_step to use proximal_l1')
+
+    def on_train_batch_end(self, outputs: Any, batch: Any, batch_idx: int, unused: int = 0) -> None:
+        if self.proximal_l1:
+            with torch.no_grad():
+                self.proximal_step(self._get_current_lr())
+
     def validation_step(self, batch: Tuple[torch.Tensor, torch.Tensor], batch_idx: int) -> Dict[str, Any]:
         x, y = batch
         y_hat = self(x)
@@ -48,23 +69,32 @@ class BaseNet(LightningModule):
         return {'val_loss': loss, 'batch_len': x.shape[0]}
     
     def calculate_avg_epoch_metric(self, outputs: List[Dict[str, Any]], metric_name: str) -> float:
-        total_len = sum(out['batch_len'] for out in outputs)
-        avg_loss = sum(out[metric_name].item()*out['batch_len'] for out in outputs)/total_len
-        return avg_loss if isinstance(avg_loss, float) else avg_loss.item()
+        # weighted average is calculated on device to synchronize with host only once per epoch
+        metrics = torch.stack([out[metric_name].detach() for out in outputs]).double()
+        batch_lens = torch.tensor([out['batch_len'] for out in outputs], device=metrics.device, dtype=metrics.dtype)
+        return ((metrics*batch_lens).sum()/batch_lens.sum()).item()
 
     def training_epoch_end(self, outputs: List[Dict[str, Any]]) -> None:
-        avg_loss = self.calculate_avg_epoch_metric(outputs, 'loss')
         avg_raw_loss = self.calculate_avg_epoch_metric(outputs, 'raw_loss')
-        avg_reg = self.calculate_avg_epoch_metric(outputs, 'reg')
-        mlflow.log_metric('train_loss', avg_loss, self.fl_current_epoch())
-        mlflow.log_metric('raw_loss', avg_raw_loss, self.fl_current_epoch())
-        mlflow.log_metric('reg', avg_reg, self.fl_current_epoch())
-        mlflow.log_metric('lr', self._get_current_lr(), self.fl_current_epoch())
+        if self.proximal_l1:
+            # penalty is not a part of the loss, we report its value at the end of epoch
+            with torch.no_grad():
+                avg_reg = self.regularization().item()
+            avg_loss = avg_raw_loss + avg_reg
+        else:
+            avg_loss = self.calculate_avg_epoch_metric(outputs, 'loss')
+            avg_reg = self.calculate_avg_epoch_metric(outputs, 'reg')
+        log_metrics_async({
+            'train_loss': avg_loss,
+            'raw_loss': avg_raw_loss,
+            'reg': avg_reg,
+            'lr': self._get_current_lr()
+        }, self.fl_current_epoch())
         # self.log('train_loss', avg_loss)
 
     def validation_epoch_end(self, outputs: List[Dict[str, Any]]) -> None:
         avg_loss = self.calculate_avg_epoch_metric(outputs, 'val_loss')
-        mlflow.log_metric('val_loss', avg_loss, self.fl_current_epoch())
+        log_metrics_async({'val_loss': avg_loss}, self.fl_current_epoch())
         self.log('val_loss', avg_loss, prog_bar=True)    
 
     def fl_current_epoch(self):
@@ -152,6 +182,9 @@ class LinearRegressor(BaseNet):
         """        
         return self.l1 * torch.norm(self.layer.weight, p=1)
 
+    def proximal_step(self, lr: float) -> None:
+        soft_threshold_(self.layer.weight, lr*self.l1)
+
     def calculate_loss(self, y_hat, y):
         return mse_loss(y_hat.squeeze(1), y)
 
@@ -184,7 +217,7 @@ class LinearClassifier(BaseNet):
 
     def validation_epoch_end(self, outputs: List[Dict[str, Any]]) -> None:
         avg_loss = self.calculate_avg_epoch_metric(outputs, 'val_loss')
-        avg_accuracy = self.calculate_avg_val_accuracy(outputs, 'val_accuracy')
+        avg_accuracy = self.calculate_avg_epoch_metric(outputs, 'val_accuracy')
         self.log('val_loss', avg_loss)
         self.log('val_accuracy', avg_accuracy)
 
@@ -209,6 +242,9 @@ class MLPPredictor(BaseNet):
         reg = self.l1 * torch.norm(self.input.weight, p=1)
         return reg
 
+    def proximal_step(self, lr: float) -> None:
+        soft_threshold_(self.input.weight, lr*self.l1)
+
     def calculate_loss(self, y_hat, y):
         return self.loss(y_hat.squeeze(1), y)
 
@@ -253,6 +289,9 @@ class MLPClassifier(BaseNet):
     def regularization(self):
         return torch.tensor(0)
 
+    def proximal_step(self, lr: float) -> None:
+        pass
+
     def calculate_loss(self, y_hat, y):
         return self.loss(y_hat.squeeze(1), y)
 
@@ -294,6 +333,12 @@ class LassoNetRegressor(BaseNet):
             w = self.layer.weight[:, :self.layer.weight.shape[1] - self.cov_count]
             return torch.dot(alphas, torch.norm(w, p=1, dim=1))/self.hidden_size
 
+    def proximal_step(self, lr: float) -> None:
+        # each output has its own alpha, covariate weights are not regularized
+        thresholds = torch.tensor(self.alphas, device=self.layer.weight.device, dtype=self.layer.weight.dtype)
+        thresholds = (lr*thresholds/self.hidden_size).unsqueeze(1)
+        soft_threshold_(self.layer.weight[:, :self.layer.weight.shape[1] - self.cov_count], thresholds)
+
     def _unreduced_mse_loss(self, y_pred: torch.Tensor, y_true: torch.Tensor) -> List[float]:
         return [mse_loss(y_pred[:, i], y_true).item() for i in range(self.hidden_size)]
 
@@ -0,0 +1,31 @@
+import pytest
+import torch
+
+pytest.importorskip('pytorch_lightning')
+from nn.models import LinearRegressor
+
+
+def test_proximal_l1_step():
+    lr, l1 = 0.5, 0.2
+    model = LinearRegressor(4, l1=l1, optim_params={'name': 'sgd', 'lr': lr, 'proximal_l1': True}, scheduler_params=None)
+    with torch.no_grad():
+        model.layer.weight.copy_(torch.tensor([[0.05, -0.1, 0.3, -0.5]]))
+        model.layer.bias.fill_(0.0)
+    model._get_current_lr = lambda: lr
+    optimizer = torch.optim.SGD(model.parameters(), lr=lr)
+
+    # zero inputs give zero gradient of the loss for weights, so only the proximal step changes them
+    x, y = torch.zeros(3, 4), torch.ones(3)
+    out = model.training_step((x, y), 0)
+    # l1 term is not a part of the loss
+    assert 'reg' not in out
+    assert torch.equal(out['loss'], model.calculate_loss(model(x), y))
+    optimizer.zero_grad()
+    out['loss'].backward()
+    optimizer.step()
+    model.on_train_batch_end(out, (x, y), 0)
+
+    # weights with |w| <= lr*l1 = 0.1 become zero, others are shrunk by 0.1
+    assert torch.allclose(model.layer.weight, torch.tensor([[0.0, 0.0, 0.2, -0.4]]))
+    # bias is updated by the optimizer step only
+    assert torch.allclose(model.layer.bias, torch.tensor([lr*2.0]))
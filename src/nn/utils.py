@@ -1,13 +1,168 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+import atexit
+import inspect
+import logging
+import os
+import queue
+import threading
+import time
+from urllib.parse import urlparse
 import mlflow
+import mlflow.utils.rest_utils
+from mlflow.entities import Metric
+from mlflow.tracking import MlflowClient
+import requests
+from requests.adapters import HTTPAdapter
+from packaging.version import Version
+import urllib3
+from urllib3.util.retry import Retry
 from abc import ABC, abstractmethod
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 from flwr.common import weights_to_parameters
 import numpy
-import pickle
+
+
+# batches of (run_id, metrics) waiting to be sent to the tracking server by _log_worker
+_log_queue = queue.Queue()
+_log_thread: Optional[threading.Thread] = None
+# run_id -> metrics kept in memory until flush_metrics when FAST_MLFLOW=1 and tracking store is local
+_pending_metrics: Dict[str, List[Metric]] = {}
+# maximum number of metrics in one log_batch request accepted by mlflow
+LOG_BATCH_LIMIT = 1000
+
+
+def _log_worker() -> None:
+    client = MlflowClient()
+    while True:
+        run_id, metrics = _log_queue.get()
+        try:
+            client.log_batch(run_id, metrics=metrics)
+        except Exception as e:
+            logging.getLogger(__name__).error(f'failed to log {len(metrics)} metrics to run {run_id}: {e}')
+        finally:
+            _log_queue.task_done()
+
+
+def log_metrics_async(metrics: Dict[str, float], step: Optional[int] = None) -> None:
+    """Enqueues {metrics} of the active mlflow run and returns immediately.
+    Metrics are sent with one log_batch request by a background thread.
+    Without an active run metrics are logged synchronously by mlflow.log_metrics
+
+    Args:
+        metrics (Dict[str, float]): Metric names and values
+        step (Optional[int]): Metric step. Default of None logs metrics at step 0
+    """    
+    active_run = mlflow.active_run()
+    if active_run is None:
+        # mlflow.log_metrics starts a run implicitly, like mlflow.log_metric did before metrics were sent asynchronously
+        mlflow.log_metrics(metrics, step=step)
+        return
+    timestamp = int(time.time() * 1000)
+    batch = [Metric(key, float(value), timestamp, step or 0) for key, value in metrics.items()]
+    run_id = active_run.info.run_id
+    if _buffer_metrics():
+        _pending_metrics.setdefault(run_id, []).extend(batch)
+    else:
+        _enqueue_metrics(run_id, batch)
+
+
+def _buffer_metrics() -> bool:
+    # local file store writes a file per metric and step, with FAST_MLFLOW=1 metrics are written once per run
+    return os.environ.get('FAST_MLFLOW') == '1' and urlparse(mlflow.get_tracking_uri()).scheme in ['', 'file']
+
+
+def _enqueue_metrics(run_id: str, metrics: List[Metric]) -> None:
+    global _log_thread
+    # thread does not survive fork, child processes start their own 
+    if _log_thread is None or not _log_thread.is_alive():
+        _log_thread = threading.Thread(target=_log_worker, daemon=True)
+        _log_thread.start()
+    _log_queue.put((run_id, metrics))
+
+
+def flush_metrics() -> None:
+    """Sends metrics buffered in memory and blocks until all metrics enqueued by log_metrics_async are sent
+    """    
+    for run_id, metrics in _pending_metrics.items():
+        for start in range(0, len(metrics), LOG_BATCH_LIMIT):
+            _enqueue_metrics(run_id, metrics[start:start + LOG_BATCH_LIMIT])
+    _pending_metrics.clear()
+    if _log_thread is not None and _log_thread.is_alive():
+        _log_queue.join()
+
+
+# multiprocessing children skip atexit handlers and should call flush_metrics explicitly
+atexit.register(flush_metrics)
+
+
+# requests.Session is not thread-safe, each thread keeps its own sessions
+_http_sessions = threading.local()
+
+
+def _mlflow_retry(max_retries: int, backoff_factor: float, retry_codes: List[int]) -> Retry:
+    # same retry policy as mlflow 1.x builds for every request, urllib3 1.26 renamed method_whitelist to allowed_methods
+    retry_kwargs = {
+        'total': max_retries,
+        'connect': max_retries,
+        'read': max_retries,
+        'redirect': max_retries,
+        'status': max_retries,
+        'status_forcelist': retry_codes,
+        'backoff_factor': backoff_factor,
+    }
+    if Version(urllib3.__version__) >= Version('1.26.0'):
+        retry_kwargs['allowed_methods'] = None
+    else:
+        retry_kwargs['method_whitelist'] = None
+    return Retry(**retry_kwargs)
+
+
+def _get_http_response_with_keep_alive(method, url, max_retries, backoff_factor, retry_codes, **kwargs):
+    # forked processes inherit sessions of the parent thread and must not share its sockets
+    if getattr(_http_sessions, 'pid', None) != os.getpid():
+        _http_sessions.pid = os.getpid()
+        _http_sessions.by_policy = {}
+    sessions = _http_sessions.by_policy
+    policy = (max_retries, backoff_factor, tuple(retry_codes))
+    if policy not in sessions:
+        retry = _mlflow_retry(max_retries, backoff_factor, retry_codes)
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=4))
+        session.mount('http://', HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=4))
+        sessions[policy] = session
+    return sessions[policy].request(method, url, **kwargs)
+
+
+# signature of the private mlflow 1.x helper replaced by enable_mlflow_keep_alive
+_MLFLOW_HTTP_HELPER_PARAMS = ['method', 'url', 'max_retries', 'backoff_factor', 'retry_codes', 'kwargs']
+
+
+def enable_mlflow_keep_alive() -> bool:
+    """Makes mlflow REST client reuse HTTP connections to the tracking server.
+    mlflow 1.x opens a new requests.Session, i.e. a new TCP and TLS connection, for every request.
+    Does nothing if installed mlflow has a different private helper, newer versions pool connections themselves
+
+    Returns:
+        bool: True if connection reuse was enabled
+    """    
+    rest_utils = mlflow.utils.rest_utils
+    if not hasattr(rest_utils, '_get_http_response_with_retries'):
+        logging.getLogger(__name__).info(f'mlflow {mlflow.__version__} has no HTTP helper to patch, skipping enable_mlflow_keep_alive')
+        return False
+    helper = rest_utils._get_http_response_with_retries
+    if helper is _get_http_response_with_keep_alive:
+        return True
+    if list(inspect.signature(helper).parameters) != _MLFLOW_HTTP_HELPER_PARAMS:
+        logging.getLogger(__name__).info(f'mlflow {mlflow.__version__} is not supported by enable_mlflow_keep_alive, skipping')
+        return False
+    rest_utils._get_http_response_with_retries = _get_http_response_with_keep_alive
+    return True
 
 
 class LoaderMetrics(ABC):
+    # empty slots keep subclasses with __slots__ free of per-instance __dict__
+    __slots__ = ()
+
     @abstractmethod
     def log_to_mlflow(self) -> None:
         pass
@@ -17,6 +172,8 @@ class LoaderMetrics(ABC):
         pass
 
 class Metrics(LoaderMetrics):
+    __slots__ = ()
+
     @property
     @abstractmethod
     def val_loss(self) -> float:
@@ -28,8 +185,65 @@ class Metrics(LoaderMetrics):
         return self
 
 
+# dtype of metrics payload sent from clients to server
+METRICS_DTYPE = '<f4'
+PREFIXES = ['train', 'val', 'test']
+
+
+def pack_metrics(kind: str, parts: List[List['RegLoaderMetrics']], epoch: int, best_col: Optional[int] = None) -> Dict:
+    """Packs loss, r2 and samples of train, val and optionally test metrics into a flat float array
+
+    Args:
+        kind (str): Type of metrics, 'reg' or 'lassonet'
+        parts (List[List[RegLoaderMetrics]]): Metrics for train, val and optionally test, one list per dataset
+        epoch (int): Epoch number
+        best_col (Optional[int], optional): Best lassonet column. Defaults to None.
+
+    Returns:
+        Dict: Dict with flwr Scalar values to be sent to server
+    """    
+    array = numpy.array([[(m.loss, m.r2, m.samples) for m in part] for part in parts], dtype=METRICS_DTYPE)
+    return {
+        'metrics': array.tobytes(),
+        'kind': kind,
+        'parts': len(parts),
+        'epoch': int(epoch),
+        'best_col': -1 if best_col is None else int(best_col)
+    }
+
+
+def unpack_metrics(result: Dict) -> 'Metrics':
+    """Restores metrics packed by {pack_metrics}
+
+    Args:
+        result (Dict): Metrics dict from client evaluation results
+
+    Raises:
+        ValueError: If kind of metrics is unknown
+
+    Returns:
+        Metrics: RegMetrics or LassoNetRegMetrics
+    """    
+    array = numpy.frombuffer(result['metrics'], dtype=METRICS_DTYPE).reshape(result['parts'], -1, 3)
+    epoch = result['epoch']
+    parts = [
+        [RegLoaderMetrics(prefix, float(loss), float(r2), epoch, int(samples)) for loss, r2, samples in part] 
+        for prefix, part in zip(PREFIXES, array)
+    ]
+    test = parts[2] if len(parts) > 2 else None
+    if result['kind'] == 'reg':
+        return RegMetrics(parts[0][0], parts[1][0], test[0] if test is not None else None, epoch)
+    elif result['kind'] == 'lassonet':
+        best_col = None if result['best_col'] < 0 else result['best_col']
+        return LassoNetRegMetrics(parts[0], parts[1], test, epoch, best_col)
+    else:
+        raise ValueError(f'kind of metrics should be one of ["reg", "lassonet"] and not {result["kind"]}')
+
+
 @dataclass
 class RegLoaderMetrics(LoaderMetrics):
+    # created for every client, lasso column and epoch; dataclass(slots=True) needs python 3.10
+    __slots__ = ('prefix', 'loss', 'r2', 'epoch', 'samples')
     # type of dataset, one of the {train, val, test}
     prefix: str
     # loss value
@@ -42,8 +256,7 @@ class RegLoaderMetrics(LoaderMetrics):
     samples: int
 
     def log_to_mlflow(self) -> None:
-        mlflow.log_metric(f'{self.prefix}_loss', self.loss, self.epoch)
-        mlflow.log_metric(f'{self.prefix}_r2', self.r2, self.epoch)
+        log_metrics_async(self.to_result_dict(), self.epoch)
 
     def to_result_dict(self) -> Dict:
         return {f'{self.prefix}_loss': self.loss, f'{self.prefix}_r2': self.r2}
@@ -51,6 +264,7 @@ class RegLoaderMetrics(LoaderMetrics):
 
 @dataclass
 class RegMetrics(Metrics):
+    __slots__ = ('train', 'val', 'test', 'epoch')
     train: RegLoaderMetrics
     val: RegLoaderMetrics
     test: RegLoaderMetrics
@@ -61,15 +275,15 @@ class RegMetrics(Metrics):
         return self.val.loss
 
     def log_to_mlflow(self) -> None:
-        self.train.log_to_mlflow()
-        self.val.log_to_mlflow()
+        # one request for all datasets
+        metrics = self.train.to_result_dict() | self.val.to_result_dict()
         if self.test is not None:
-            self.test.log_to_mlflow()
+            metrics |= self.test.to_result_dict()
+        log_metrics_async(metrics, self.val.epoch)
 
     def to_result_dict(self) -> Dict:
-        # train_dict, val_dict, test_dict = [m.to_result_dict() for m in [self.train, self.val, self.test]]
-        # return train_dict | val_dict | test_dict
-        return {'metrics' : pickle.dumps(self)}
+        parts = [[self.train], [self.val]] if self.test is None else [[self.train], [self.val], [self.test]]
+        return pack_metrics('reg', parts, self.epoch)
 
 
 @dataclass
@@ -79,6 +293,8 @@ class LassoNetRegMetrics(Metrics):
     test: List[RegLoaderMetrics] = None
     epoch: int = 0
     best_col: int = None
+    # id(metric_list) -> (metric_list, its length, mean metrics), val_loss, __str__ and logging reuse the same means
+    _mean_cache: Dict = field(default_factory=dict, init=False, repr=False, compare=False)
 
     @property
     def val_loss(self) -> float:
@@ -90,28 +306,34 @@ class LassoNetRegMetrics(Metrics):
     def _calculate_mean_metrics(self, metric_list: Optional[List[RegLoaderMetrics]]) -> RegLoaderMetrics:
         if metric_list is None or len(metric_list) == 0:
             return None
+        cached_list, cached_length, cached_mean = self._mean_cache.get(id(metric_list), (None, 0, None))
+        # list is stored in the cache, so its id cannot be reused; appended lists are recalculated
+        if cached_list is metric_list and cached_length == len(metric_list):
+            return cached_mean
         mean_loss = sum([m.loss for m in metric_list])/len(metric_list)
         mean_r2 = sum([m.r2 for m in metric_list])/len(metric_list)
         samples = sum([m.samples for m in metric_list])/len(metric_list)
-        return RegLoaderMetrics(metric_list[0].prefix, mean_loss, mean_r2, metric_list[0].epoch, samples)
+        mean = RegLoaderMetrics(metric_list[0].prefix, mean_loss, mean_r2, metric_list[0].epoch, samples)
+        self._mean_cache[id(metric_list)] = (metric_list, len(metric_list), mean)
+        return mean
 
-    def log_to_mlflow(self) -> None:
+    def _selected_metrics(self) -> Tuple[RegLoaderMetrics, RegLoaderMetrics, Optional[RegLoaderMetrics]]:
+        # metrics of the best lasso model if it is known and the mean over all lasso models otherwise
         if self.best_col is None:
             train, val, test = map(self._calculate_mean_metrics, [self.train, self.val, self.test])
-            train.log_to_mlflow()
-            val.log_to_mlflow()
-            if test is not None:
-                test.log_to_mlflow()
         else:
-            print(f'LassoNetRegMetrics DEBUG log_to_mlflow(): {self.train[self.best_col]}, {self.val[self.best_col]}')
             train, val = self.train[self.best_col], self.val[self.best_col]
-            train.log_to_mlflow()
-            val.log_to_mlflow()
-            if self.test is not None and len(self.test) > 0:
-                self.test[self.best_col].log_to_mlflow()
+            test = self.test[self.best_col] if self.test is not None and len(self.test) > 0 else None
+        return train, val, test
+
+    def log_to_mlflow(self) -> None:
+        if self.best_col is not None:
+            print(f'LassoNetRegMetrics DEBUG log_to_mlflow(): {self.train[self.best_col]}, {self.val[self.best_col]}')
+        RegMetrics(*self._selected_metrics(), self.epoch).log_to_mlflow()
 
     def to_result_dict(self) -> Dict:
-        return {'metrics': pickle.dumps(self)}
+        parts = [self.train, self.val] if self.test is None or len(self.test) == 0 else [self.train, self.val, self.test]
+        return pack_metrics('lassonet', parts, self.epoch, self.best_col)
 
     def reduce(self, reduction='mean'):
         """Reduces LassoNET metrics on hidden_size axis
@@ -140,41 +362,46 @@ class LassoNetRegMetrics(Metrics):
             raise ValueError(f'reduction should be one of ["mean", "lassonet_best"]')
 
     def __str__(self) -> str:
-
-        if self.best_col is None:
-            train, val, test = map(self._calculate_mean_metrics, [self.train, self.val, self.test])
-            train_val_str = f'train_loss: {train.loss:.4f}\ttrain_r2: {train.r2:.4f}\tval_loss: {val.loss:.4f}\tval_r2: {val.r2:.4f}'
-            if test is not None:
-                return train_val_str + f'\ttest_loss: {test.loss:.4f}\ttest_r2: {test.r2:.4f}'
-            else:
-                return train_val_str
+        train, val, test = self._selected_metrics()
+        train_val_str = f'train_loss: {train.loss:.4f}\ttrain_r2: {train.r2:.4f}\tval_loss: {val.loss:.4f}\tval_r2: {val.r2:.4f}'
+        if test is not None:
+            return train_val_str + f'\ttest_loss: {test.loss:.4f}\ttest_r2: {test.r2:.4f}'
         else:
-            train, val = self.train[self.best_col], self.val[self.best_col]
-            train_val_str = f'train_loss: {train.loss:.4f}\ttrain_r2: {train.r2:.4f}\tval_loss: {val.loss:.4f}\tval_r2: {val.r2:.4f}'
-            if self.test is not None and len(self.test) > 0:
-                test = self.test[self.best_col]
-                return train_val_str + f'\ttest_loss: {test.loss:.4f}\ttest_r2: {test.r2:.4f}'
-            else:
-                return train_val_str
+            return train_val_str
         
 
 @dataclass
 class RegFederatedMetrics(Metrics):
-    
+    __slots__ = ('clients', 'epoch')
     clients: List[Metrics]
     epoch: int
     
     def _weighted_mean_metrics(self, metric_list: List[LoaderMetrics]) -> Metrics:
         if metric_list[0] is None:
             return None
-        samples = sum([m.samples for m in metric_list])
-        mean_weighted_loss = sum([m.loss*m.samples/samples for m in metric_list])
-        mean_weighted_r2 = sum([m.r2*m.samples/samples for m in metric_list])
-        return RegLoaderMetrics(metric_list[0].prefix, mean_weighted_loss, mean_weighted_r2, self.epoch, samples)
+        return self._weighted_mean_columns([[m] for m in metric_list])[0]
+
+    def _weighted_mean_columns(self, metric_table: List[List[RegLoaderMetrics]]) -> List[RegLoaderMetrics]:
+        """Averages each column of clients x columns table of metrics weighted by client sample counts
+
+        Args:
+            metric_table (List[List[RegLoaderMetrics]]): One row of metrics for each client
+
+        Returns:
+            List[RegLoaderMetrics]: Aggregated metrics for each column
+        """        
+        # clients x columns x (loss, r2, samples)
+        array = numpy.array([[(m.loss, m.r2, m.samples) for m in row] for row in metric_table], dtype=numpy.float64)
+        samples = array[:, :, 2]
+        total_samples = samples.sum(axis=0)
+        means = (array[:, :, :2] * samples[:, :, None]).sum(axis=0) / total_samples[:, None]
+        prefix = metric_table[0][0].prefix
+        return [RegLoaderMetrics(prefix, float(loss), float(r2), self.epoch, int(total)) 
+                for (loss, r2), total in zip(means, total_samples)]
 
     @property
     def val_loss(self) -> float:
-        return self._weighted_mean_metrics('val', [client.val for client in self.clients]).val_loss
+        return self.reduce().val_loss
 
     def reduce(self, reduction='mean'):
         """Reduces metrics from all clients into one metrics aggregated over all clients
@@ -188,27 +415,20 @@ class RegFederatedMetrics(Metrics):
             RegMetrics | LassoNetRegMetrics: Standard aggregated metrics or lassonet multioutput metrics with best_col attribute set.
         """        
         if not isinstance(self.clients[0].train, List):
-            reduced_clients = [
-                [m.reduce().train for m in self.clients], 
-                [m.reduce().val for m in self.clients], 
-                [m.reduce().test for m in self.clients]
-            ]
-            train, val, test = map(self._weighted_mean_metrics, reduced_clients)
+            reduced_clients = [m.reduce() for m in self.clients]
+            train, val, test = map(self._weighted_mean_metrics, [
+                [m.train for m in reduced_clients], 
+                [m.val for m in reduced_clients], 
+                [m.test for m in reduced_clients]
+            ])
             return RegMetrics(train, val, test, self.epoch)
         else:
-            lassonet_metrics = LassoNetRegMetrics([], [], [], epoch=self.epoch)
-            for col in range(len(self.clients[0].train)):
-                train_col_list = [m.train[col] for m in self.clients]
-                val_col_list = [m.val[col] for m in self.clients]
-                train, val = map(self._weighted_mean_metrics, [train_col_list, val_col_list])
-                lassonet_metrics.train.append(train)
-                lassonet_metrics.val.append(val)
-                if self.clients[0].test is not None:
-                    test_col_list = [m.test[col] for m in self.clients]
-                    test = self._weighted_mean_metrics(test_col_list)
-                    lassonet_metrics.test.append(test)
-            lassonet_metrics.best_col = numpy.argmax([vm.r2 for vm in lassonet_metrics.val])
-            return lassonet_metrics
+            # all lasso columns are reduced at once over the clients axis
+            train = self._weighted_mean_columns([m.train for m in self.clients])
+            val = self._weighted_mean_columns([m.val for m in self.clients])
+            test = self._weighted_mean_columns([m.test for m in self.clients]) if self.clients[0].test else []
+            best_col = int(numpy.argmax([vm.r2 for vm in val]))
+            return LassoNetRegMetrics(train, val, test, epoch=self.epoch, best_col=best_col)
 
     def log_to_mlflow(self) -> None:
         return self.reduce().log_to_mlflow()
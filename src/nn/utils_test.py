@@ -1,5 +1,9 @@
+import threading
+from types import SimpleNamespace
+import mlflow
 import pytest
-from nn.utils import RegFederatedMetrics, LassoNetRegMetrics, RegLoaderMetrics
+from nn import utils
+from nn.utils import RegFederatedMetrics, LassoNetRegMetrics, RegLoaderMetrics, RegMetrics, unpack_metrics, log_metrics_async, flush_metrics, enable_mlflow_keep_alive
 
 
 def test_RegFederatedMetrics_reduce():
@@ -43,4 +47,134 @@ def test_RegFederatedMetrics_reduce_unbalanced():
     assert 0.23 < red_metrics.val_loss < 0.24
     final_metrics = red_metrics.reduce('lassonet_best')
     assert 0.76 < final_metrics.val.r2 < 0.77
-    assert 0.23 < final_metrics.val_loss < 0.24
\ No newline at end of file
+    assert 0.23 < final_metrics.val_loss < 0.24
+
+def test_RegMetrics_pack_unpack_without_test():
+    metrics = RegMetrics(RegLoaderMetrics('train', 0.5, 0.25, 3, 1000), RegLoaderMetrics('val', 0.75, 0.125, 3, 500), None, 3)
+    unpacked = unpack_metrics(metrics.to_result_dict())
+    assert isinstance(unpacked, RegMetrics)
+    assert unpacked == metrics
+
+
+def test_RegMetrics_pack_unpack_with_test():
+    metrics = RegMetrics(
+        RegLoaderMetrics('train', 0.5, 0.25, 3, 1000), 
+        RegLoaderMetrics('val', 0.75, 0.125, 3, 500), 
+        RegLoaderMetrics('test', 1.5, -0.5, 3, 250), 
+        3
+    )
+    unpacked = unpack_metrics(metrics.to_result_dict())
+    assert unpacked == metrics
+    assert isinstance(unpacked.test.samples, int)
+
+
+@pytest.mark.parametrize('best_col', [None, 1])
+def test_LassoNetRegMetrics_pack_unpack(best_col):
+    metrics = LassoNetRegMetrics(
+        [RegLoaderMetrics('train', 0.5, 0.5, 2, 1000), RegLoaderMetrics('train', 0.25, 0.75, 2, 1000)], 
+        [RegLoaderMetrics('val', 0.125, 0.875, 2, 100), RegLoaderMetrics('val', 0.25, 0.75, 2, 100)],
+        [RegLoaderMetrics('test', 0.375, 0.625, 2, 50), RegLoaderMetrics('test', 0.5, 0.5, 2, 50)],
+        epoch=2,
+        best_col=best_col
+    )
+    unpacked = unpack_metrics(metrics.to_result_dict())
+    assert isinstance(unpacked, LassoNetRegMetrics)
+    assert unpacked == metrics
+    assert unpacked.best_col == best_col
+
+
+def test_unpack_metrics_unknown_kind():
+    result = RegMetrics(RegLoaderMetrics('train', 0.5, 0.25, 3, 1000), RegLoaderMetrics('val', 0.75, 0.125, 3, 500), None, 3).to_result_dict()
+    result['kind'] = 'unknown'
+    with pytest.raises(ValueError):
+        unpack_metrics(result)
+
+
+def test_RegFederatedMetrics_reduce_unpacked_clients():
+    clients = [
+        LassoNetRegMetrics(
+            [RegLoaderMetrics('train', 0.5, 0.5, 1, 1000), RegLoaderMetrics('train', 0.25, 0.75, 1, 1000)], 
+            [RegLoaderMetrics('val', 0.1, 0.9, 1, 1000), RegLoaderMetrics('val', 0.2, 0.8, 1, 1000)],       
+            epoch=1
+        ),
+        LassoNetRegMetrics(
+            [RegLoaderMetrics('train', 0.75, 0.25, 1, 1000), RegLoaderMetrics('train', 0.5, 0.5, 1, 1000)], 
+            [RegLoaderMetrics('val', 0.3, 0.7, 1, 1000), RegLoaderMetrics('val', 0.4, 0.6, 1, 1000)],       
+            epoch=1
+        )
+    ]
+    unpacked = [unpack_metrics(client.to_result_dict()) for client in clients]
+    red_metrics = RegFederatedMetrics(unpacked, 1).reduce('lassonet_best')
+    assert red_metrics.best_col == 0
+    assert red_metrics.train[0].loss == pytest.approx(0.625)
+    assert red_metrics.val[0].loss == pytest.approx(0.2)
+    assert red_metrics.val[0].samples == 2000
+
+    reg_clients = [
+        RegMetrics(RegLoaderMetrics('train', 0.5, 0.5, 1, 1000), RegLoaderMetrics('val', 0.1, 0.9, 1, 1000), None, 1),
+        RegMetrics(RegLoaderMetrics('train', 0.75, 0.25, 1, 3000), RegLoaderMetrics('val', 0.3, 0.7, 1, 3000), None, 1)
+    ]
+    reg_metrics = RegFederatedMetrics([unpack_metrics(client.to_result_dict()) for client in reg_clients], 1).reduce()
+    assert reg_metrics.train.loss == pytest.approx(0.6875)
+    assert reg_metrics.val.r2 == pytest.approx(0.75)
+    assert reg_metrics.test is None
+
+
+def test_log_metrics_async_without_active_run(monkeypatch):
+    logged = []
+    monkeypatch.setattr(mlflow, 'active_run', lambda: None)
+    monkeypatch.setattr(mlflow, 'log_metrics', lambda metrics, step=None: logged.append((metrics, step)))
+    log_metrics_async({'train_loss': 0.5}, 3)
+    assert logged == [({'train_loss': 0.5}, 3)]
+
+
+def test_flush_metrics_after_worker_exception(monkeypatch):
+    sent = []
+
+    class FailingClient:
+        def log_batch(self, run_id, metrics):
+            if metrics[0].key == 'fail':
+                raise RuntimeError('tracking server is down')
+            sent.append((run_id, [metric.key for metric in metrics]))
+
+    monkeypatch.delenv('FAST_MLFLOW', raising=False)
+    monkeypatch.setattr(utils, 'MlflowClient', FailingClient)
+    monkeypatch.setattr(utils, '_log_thread', None)
+    monkeypatch.setattr(mlflow, 'active_run', lambda: SimpleNamespace(info=SimpleNamespace(run_id='run')))
+    log_metrics_async({'fail': 1.0}, 1)
+    log_metrics_async({'val_loss': 2.0}, 1)
+
+    flush = threading.Thread(target=flush_metrics, daemon=True)
+    flush.start()
+    flush.join(timeout=10)
+    assert not flush.is_alive()
+    # worker keeps sending metrics after a failed request
+    assert sent == [('run', ['val_loss'])]
+
+
+@pytest.mark.parametrize('urllib3_version,methods_kwarg', [('1.26.8', 'allowed_methods'), ('1.25.11', 'method_whitelist')])
+def test_mlflow_retry_matches_urllib3_version(monkeypatch, urllib3_version, methods_kwarg):
+    retry_kwargs = {}
+    monkeypatch.setattr(utils.urllib3, '__version__', urllib3_version)
+    monkeypatch.setattr(utils, 'Retry', lambda **kwargs: retry_kwargs.update(kwargs))
+    utils._mlflow_retry(5, 2, [429, 503])
+    assert retry_kwargs[methods_kwarg] is None
+    assert retry_kwargs['status_forcelist'] == [429, 503]
+
+
+def test_enable_mlflow_keep_alive(monkeypatch):
+    def mlflow_1_helper(method, url, max_retries, backoff_factor, retry_codes, **kwargs):
+        pass
+
+    def newer_helper(method, url, max_retries, backoff_factor, backoff_jitter, retry_codes, raise_on_status, **kwargs):
+        pass
+
+    rest_utils = mlflow.utils.rest_utils
+    monkeypatch.delattr(rest_utils, '_get_http_response_with_retries', raising=False)
+    assert not enable_mlflow_keep_alive()
+    monkeypatch.setattr(rest_utils, '_get_http_response_with_retries', newer_helper, raising=False)
+    assert not enable_mlflow_keep_alive()
+    assert rest_utils._get_http_response_with_retries is newer_helper
+    monkeypatch.setattr(rest_utils, '_get_http_response_with_retries', mlflow_1_helper)
+    assert enable_mlflow_keep_alive()
+    assert rest_utils._get_http_response_with_retries is utils._get_http_response_with_keep_alive
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 import os
 import sys
 import pandas as pd
@@ -18,6 +19,10 @@ from configs.split_config import non_iid_split_name, uniform_split_config, split
 import logging
 from os import path, symlink
 
+
+# each projection is a small plink job, several single-threaded jobs use cores better than one job with all of them
+PROJECTION_PLINK_THREADS = 1
+
 if __name__ == '__main__':
     # runs the whole pipeline
     logging.basicConfig(level=logging.INFO,
@@ -75,16 +80,11 @@ if __name__ == '__main__':
     #
     # for fold_index in range(FOLDS_NUMBER):
     #     # Perform centralised sample ids merge to use it with `--keep` flag in plink
-    #     ids = []
-    #
-    #     for node in nodes:
-    #         ids_filepath = superpop_split.get_ids_path(
-    #             fold_index=fold_index,
-    #             part_name='train',
-    #             node=node
-    #         )
-    #
-    #         ids.extend(pd.read_csv(ids_filepath, sep='\t')['IID'].to_list())
+    #     ids = pd.concat([
+    #         pd.read_csv(superpop_split.get_ids_path(fold_index=fold_index, part_name='train', node=node),
+    #                     sep='\t', usecols=['IID'], dtype={'IID': str}, engine='c')['IID']
+    #         for node in nodes
+    #     ], ignore_index=True)
     #
     #     # Store the list of ids inside the super population split file structure
     #     centralised_ids_filepath = superpop_split.get_ids_path(
@@ -108,14 +108,20 @@ if __name__ == '__main__':
         )
 
         logger.info(f'Projecting train, test, and val parts for each node for fold {fold_index}...')
-        for node in nodes:
-            for part_name in ['train', 'val', 'test']:
-                run_plink(
-                    args_list=[
-                        '--pfile', superpop_split.get_pfile_path(node=node, fold_index=fold_index, part_name=part_name),
-                        '--read-freq', superpop_split.get_pca_path(node='ALL', fold_index=fold_index, part='train', ext='.acount'),
-                        '--score', superpop_split.get_pca_path(node='ALL', fold_index=fold_index, part='train', ext='.eigenvec.allele'), '2', '5', 'header-read', 'no-mean-imputation', 'variance-standardize', '--score-col-nums', '6-25',
-                        '--out', superpop_split.get_pca_path(node=node, fold_index=fold_index, part=part_name),
-                        '--set-missing-var-ids', '@:#'
-                    ]
-                )
+        projection_args = [
+            [
+                '--pfile', superpop_split.get_pfile_path(node=node, fold_index=fold_index, part_name=part_name),
+                '--read-freq', superpop_split.get_pca_path(node='ALL', fold_index=fold_index, part='train', ext='.acount'),
+                '--score', superpop_split.get_pca_path(node='ALL', fold_index=fold_index, part='train', ext='.eigenvec.allele'), '2', '5', 'header-read', 'no-mean-imputation', 'variance-standardize', '--score-col-nums', '6-25',
+                '--out', superpop_split.get_pca_path(node=node, fold_index=fold_index, part=part_name),
+                '--set-missing-var-ids', '@:#',
+                '--threads', str(PROJECTION_PLINK_THREADS)
+            ]
+            for node in nodes for part_name in ['train', 'val', 'test']
+        ]
+        # threads only wait for plink subprocesses, GIL is not a bottleneck here
+        # CPUs allotted to the job (e.g. SLURM --cpus-per-task), os.cpu_count() reports all cores of the host
+        workers = max(1, len(os.sched_getaffinity(0)) // PROJECTION_PLINK_THREADS)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # list() propagates RuntimeError of a failed plink run
+            list(executor.map(run_plink, projection_args))
@@ -1,7 +1,25 @@
 from typing import List, Set, Tuple
+import numpy
 import pandas
 
 
+GWAS_COLUMNS = ['#CHROM', 'POS', 'ID', 'LOG10_P']
+
+
+def read_gwas(gwas_path: str) -> pandas.DataFrame:
+    """Reads only #CHROM, POS, ID and LOG10_P columns of plink 2.0 GWAS results
+
+    Args:
+        gwas_path (str): Path to plink 2.0 --glm results
+
+    Returns:
+        pandas.DataFrame: GWAS results with #CHROM, POS, LOG10_P columns and ID as index
+    """    
+    # LOG10_P stays float64, float32 would turn close p-values into ties and change top SNPs
+    gwas = pandas.read_table(gwas_path, usecols=GWAS_COLUMNS, dtype={'#CHROM': 'category', 'POS': numpy.int32}, engine='c')
+    return gwas.set_index('ID')
+
+
 def read_all_gwas(gwas_sources: List[str]) -> List[pandas.DataFrame]:
     """
     Reads all GWAS results for a particular phenotype and split from {gwas_dir}
@@ -12,11 +30,7 @@ def read_all_gwas(gwas_sources: List[str]) -> List[pandas.DataFrame]:
     Returns:
         List[pandas.DataFrame]: List of GWAS results with #CHROM, POS, LOG10_P columns and ID as index 
     """    
-    results = []
-    for gwas_path in gwas_sources:
-        gwas = pandas.read_table(gwas_path)
-        results.append(gwas.loc[:, ['#CHROM', 'POS', 'ID', 'LOG10_P']].set_index('ID'))
-    return results
+    return [read_gwas(gwas_path) for gwas_path in gwas_sources]
 
 
 def get_topk_snps(gwas: pandas.DataFrame, max_snp_count: int) -> pandas.DataFrame:
@@ -29,6 +43,7 @@ def get_topk_snps(gwas: pandas.DataFrame, max_snp_count: int) -> pandas.DataFram
     Returns:
         pandas.DataFrame: DataFrame with {max_snp_count} most significant SNPs where index is SNP ID 
     """    
-    sorted_gwas = gwas.sort_values(by='LOG10_P', axis='index', ascending=False).iloc[:max_snp_count, :]
-    return sorted_gwas.drop('LOG10_P', axis='columns')
+    # heap-based partial selection keeps the descending order without sorting all SNPs
+    topk_gwas = gwas.nlargest(max_snp_count, 'LOG10_P')
+    return topk_gwas.drop('LOG10_P', axis='columns')
 